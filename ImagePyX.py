@@ -13,6 +13,7 @@ import optparse
 import logging
 import sys
 from SSWIMM import *
+from SSWIMM import Codecs
 
 if __name__ == '__main__':
 	help_s = """
@@ -25,7 +26,10 @@ if __name__ == '__main__':
 %prog [options] --info <file.wim>
 %prog [options] --split <file.wim> <SWM max size MiB>
 %prog [options] --apply <file.wim> <image> <target folder>
-%prog [options] --export <source.wim> <image> <dest.wim>"""
+%prog [options] --export <source.wim> <image> <dest.wim>
+%prog [options] --bench [<threads,...> [<chunks per stream,...> [<corpus MiB>]]]
+%prog [options] --bench records [<count>]
+%prog [options] --bench cache"""
 	par = optparse.OptionParser(usage=help_s, version="%prog 0.26 (MT)", description="Manage WIM archives.")
 	par.add_option("--capture", const=1, action="store_const", dest="sub_module", help="create a new WIM archive with folder's contents")
 	par.add_option("--append", const=2, action="store_const", dest="sub_module", help="append to (or create) a WIM archive with folder's contents")
@@ -37,6 +41,7 @@ if __name__ == '__main__':
 	par.add_option("--dir", const=8, action="store_const", dest="sub_module", help="list the image contents")
 	par.add_option("--delete", const=9, action="store_const", dest="sub_module", help="delete an image from WIM archive")
 	par.add_option("--export", const=10, action="store_const", dest="sub_module", help="export an image or all images to a WIM archive")
+	par.add_option("--bench", const=11, action="store_const", dest="sub_module", help="measure the (de)compression speed, ratio and chunk latency of the available codecs on text, binary, compressed and zeroed data; or the time and memory taken by the image records; or check the chunk cache")
 	par.add_option("-c", "--compress", dest="compression_type", help="select a compression type between none, XPRESS (default), LZX", metavar="COMPRESSION", default="xpress")
 	par.add_option("-n", "--name", dest="image_name", help="set an Image name in XML data", metavar="NAME", default=None)
 	par.add_option("-d", "--description", dest="image_description", help="set an Image description in XML data", metavar="DESC", default=None)
@@ -45,7 +50,14 @@ if __name__ == '__main__':
 	par.add_option("--debug", action="store_true", dest="debug", help="turn on debug logging to SSWIMM.log", metavar="DEBUG_LOG", default=False)
 	par.add_option("--check", action="store_true", dest="integrity_check", help="add integrity check data to image", default=False)
 	par.add_option("--threads", dest="num_threads", type="int", help="specify the number of threads used for the (de)compression", default=2)
-	par.add_option("--threshold", dest="threshold", type="string", help="instructs to abort compression if gain is less than RATIO after a specified amount 1/N of input has been processed and stream is greater than SIZE chunks\n\ni.e.: '--threshold=320,2,0.01' aborts if gain is < 1% after the 1/2 of a stream of at least 320 chunks (10 MiB) has been processed", metavar="SIZE,N,RATIO")
+	par.add_option("--scan-threads", dest="scan_threads", type="int", help="specify the number of threads listing folders and reading files metadata while capturing (default 8)", metavar="THREADS", default=8)
+	par.add_option("--workers", dest="workers", type="choice", choices=["thread", "process"], help="run the (de)compression workers as threads (default) or child processes", metavar="BACKEND", default="thread")
+	par.add_option("--autotune", action="store_true", dest="autotune", help="adjust the active (de)compression workers (up to a CPU count, starting from --threads) and chunks in flight while running; tuned values go to the debug log", default=False)
+	par.add_option("--chunk-size", dest="chunk_size", type="int", help="set the size in KiB of the compression chunks in a new WIM, a power of 2 between 32 (default) and 2048 (sizes beyond the selected codec's limit, 32 KiB for wimlib, are rejected)", metavar="KIB", default=32)
+	par.add_option("--cache-size", dest="cache_size", type="int", help="set the memory in MiB for the decompressed chunks shared by the readers (default 64, 0 disables the cache)", metavar="MIB", default=64)
+	par.add_option("--hash-cache", dest="hash_cache", help="keep in FILE the SHA-1 of the captured files, reusing it while a file keeps its size, times and inode", metavar="FILE", default=None)
+	par.add_option("--incremental", action="store_true", dest="incremental", help="with --update, don't read again the files with the same size, last write time and attributes they had in the image", default=False)
+	par.add_option("--probe", dest="probe", type="string", help="instructs to store a stream without compression if SAMPLES chunks sampled across it shrink less than RATIO with a fast compressor\n\ni.e.: '--probe=8,0.05' stores the streams longer than 8 chunks (256 KiB) whose samples gain less than 5%", metavar="SAMPLES,RATIO")
 	opts, args = par.parse_args()
 
 	if not opts.sub_module:
@@ -53,9 +65,15 @@ if __name__ == '__main__':
 		par.print_help()
 		sys.exit(1)
 
-	if opts.threshold:
-		size, chunks, ratio = opts.threshold.split(',')
-		opts.threshold.size, opts.threshold.chunks, opts.threshold.ratio = int(size), int(chunks), float(ratio)
+	if opts.chunk_size < 32 or opts.chunk_size > 2048 or opts.chunk_size & (opts.chunk_size-1):
+		print "Chunk size must be a power of 2 between 32 and 2048 KiB!\n"
+		sys.exit(1)
+	opts.chunk_size *= 1024
+	opts.cache_size <<= 20
+
+	if opts.probe:
+		samples, ratio = opts.probe.split(',')
+		opts.probe = int(samples), float(ratio)
 
 	if opts.debug:
 		logging.basicConfig(level=logging.DEBUG, filename='SSWIMM.log', filemode='w')
@@ -67,56 +85,61 @@ if __name__ == '__main__':
 			opts.exclude_list += [line[:-1]]
 		print "These items will be excluded from capture:\n", '\n'.join(opts.exclude_list)
 			
-	if opts.sub_module == 1:
-		if len(args) < 2:
-			print "You must specify a source folder to capture and a WIM file!\n"
-			sys.exit(1)
-		create(opts, args)
-	elif opts.sub_module == 2:
-		if len(args) < 2:
-			print "You must specify a source folder and a WIM file to append to/create!\n"
-			sys.exit(1)
-		if os.path.exists(args[0]):
-			append(opts, args)
-		else:
+	# The codec workers are shared by the whole operation and stopped at its end
+	opts.pool = Codecs.CodecPool(opts.num_threads, opts.workers, opts.autotune, opts.cache_size)
+	with opts.pool:
+		if opts.sub_module == 1:
+			if len(args) < 2:
+				print "You must specify a source folder to capture and a WIM file!\n"
+				sys.exit(1)
 			create(opts, args)
-	elif opts.sub_module == 3:
-		if len(args) < 3:
-			print "You must specify a source folder, a WIM file and an image (by index or name) to update!\n"
-			sys.exit(1)
-		update(opts, args)
-	elif opts.sub_module == 4:
-		if len(args) < 1:
-			print "You must specify a WIM file (and, optionally, an image index or name) to test!\n"
-			sys.exit(1)
-		test(opts, args)
-	elif opts.sub_module == 5:
-		if len(args) < 2:
-			print "You must specify a WIM file to split and the maximum SWM unit size in megabytes!\n"
-			sys.exit(1)
-		split(opts, args)
-	elif opts.sub_module == 6:
-		if len(args) < 3:
-			print "You must specify a WIM file and an image (by index or name) to apply, and a target folder!\n"
-			sys.exit(1)
-		extract(opts, args)
-	elif opts.sub_module == 7:
-		if len(args) < 1:
-			print "You must specify a WIM file to show the XML data!\n"
-			sys.exit(1)
-		info(opts, args)
-	elif opts.sub_module == 8:
-		if len(args) < 1:
-			print "You must specify a WIM file and an image (by index or name) to list contents!\n"
-			sys.exit(1)
-		list(opts, args)
-	elif opts.sub_module == 9:
-		if len(args) < 2:
-			print "You must specify a WIM file and an image (by index or name) to delete!\n"
-			sys.exit(1)
-		delete(opts, args)
-	elif opts.sub_module == 10:
-		if len(args) < 3:
-			print "You must specify a source WIM file, an image (by index or name) to export and a destination WIM file!\n"
-			sys.exit(1)
-		export(opts, args)
+		elif opts.sub_module == 2:
+			if len(args) < 2:
+				print "You must specify a source folder and a WIM file to append to/create!\n"
+				sys.exit(1)
+			if os.path.exists(args[0]):
+				append(opts, args)
+			else:
+				create(opts, args)
+		elif opts.sub_module == 3:
+			if len(args) < 3:
+				print "You must specify a source folder, a WIM file and an image (by index or name) to update!\n"
+				sys.exit(1)
+			update(opts, args)
+		elif opts.sub_module == 4:
+			if len(args) < 1:
+				print "You must specify a WIM file (and, optionally, an image index or name) to test!\n"
+				sys.exit(1)
+			test(opts, args)
+		elif opts.sub_module == 5:
+			if len(args) < 2:
+				print "You must specify a WIM file to split and the maximum SWM unit size in megabytes!\n"
+				sys.exit(1)
+			split(opts, args)
+		elif opts.sub_module == 6:
+			if len(args) < 3:
+				print "You must specify a WIM file and an image (by index or name) to apply, and a target folder!\n"
+				sys.exit(1)
+			extract(opts, args)
+		elif opts.sub_module == 7:
+			if len(args) < 1:
+				print "You must specify a WIM file to show the XML data!\n"
+				sys.exit(1)
+			info(opts, args)
+		elif opts.sub_module == 8:
+			if len(args) < 1:
+				print "You must specify a WIM file and an image (by index or name) to list contents!\n"
+				sys.exit(1)
+			list(opts, args)
+		elif opts.sub_module == 9:
+			if len(args) < 2:
+				print "You must specify a WIM file and an image (by index or name) to delete!\n"
+				sys.exit(1)
+			delete(opts, args)
+		elif opts.sub_module == 10:
+			if len(args) < 3:
+				print "You must specify a source WIM file, an image (by index or name) to export and a destination WIM file!\n"
+				sys.exit(1)
+			export(opts, args)
+		elif opts.sub_module == 11:
+			bench(opts, args)
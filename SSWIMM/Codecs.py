@@ -11,22 +11,39 @@ This free software manages MS WIM Archives WITH ABSOLUTELY NO WARRANTY!'''
 import collections
 import hashlib
 import logging
+import multiprocessing
+import operator
 import struct
 import sys
 import threading
+import time
+import zlib
 from ctypes import *
 from Queue import *
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
-Codec = None
 
 # Codecs to use with MT generic class: Copy, wimlib, MSCompression, Rtl
 class BaseCodec:
 	"Base codec"
+	max_chunk_size = 32768 # largest chunk (dwCompressionSize) the codec can (de)compress
 	def __init__(self, compression=0): pass
 	
 	def compress(self, s, z, expanded_size): pass
 		
 	def decompress(self, s, z, expanded_size): pass
+
+	def compress_group(self, parts, z, expanded_size=0):
+		"Compresses a group of single chunk streams, one by one, into consecutive areas of z"
+		zs, pos = [], 0
+		for s in parts:
+			zs += [self.compress(s, (c_char*(len(z)-pos)).from_buffer(z, pos), len(s))]
+			if zs[-1] is not s:
+				pos += len(zs[-1])
+		return zs
 	
 	def check(self, i, j, is_compressor=False):
 		if i == 0:
@@ -43,8 +60,18 @@ class CodecException():
 		print msg
 		sys.exit(1)
 		
+class CodecError(Exception):
+	pass
+
+def load_library(name):
+	"Loads a codec library once per process"
+	if name not in cdll.__dict__ and 'linux' in sys.platform:
+		setattr(cdll, name, cdll.LoadLibrary(name+'.so')) # we need to explicitly load
+	return getattr(cdll, name)
+
 class CopyCodec(BaseCodec):
 	"Copy codec"
+	max_chunk_size = 1<<31 # any
 	def __init__(self, compression=0):
 		logging.debug("Using Copy codec")
 		pass
@@ -56,18 +83,18 @@ class CopyCodec(BaseCodec):
 
 class WimlibCodec(BaseCodec):
 	"Performs XPRESS or LZX (de)compression with wimlib"
+	max_chunk_size = 32768 # the wimlib 1.3 chunk API
 	def __init__(self, codec=1):
 		try:
-			if 'linux' in sys.platform:
-				cdll.wimlib = cdll.LoadLibrary('wimlib.so') # we need to explicitly load
+			wimlib = load_library('wimlib')
 			if codec != 2:
 				logging.debug("Using wimlib XPRESS codec")
-				self.co = cdll.wimlib.xpress_compress
-				self.dec = cdll.wimlib.xpress_decompress
+				self.co = wimlib.xpress_compress
+				self.dec = wimlib.xpress_decompress
 			else:
 				logging.debug("Using wimlib LZX codec")
-				self.co = cdll.wimlib.lzx_compress
-				self.dec = cdll.wimlib.lzx_decompress
+				self.co = wimlib.lzx_compress
+				self.dec = wimlib.lzx_decompress
 		except:
 			#~ raise CodecException("Can't load wimlib 1.2.5 library!")
 			raise CodecException("Can't load wimlib >=1.3.x library!")
@@ -87,7 +114,7 @@ class WimlibCodec(BaseCodec):
 			self.check(cb, len(s), True)
 			return s
 		else:
-			return z[:cb]
+			return buffer(z, 0, cb)
 		
 	def decompress(self, s, z, expanded_size):
 		if len(s) == expanded_size:
@@ -95,23 +122,23 @@ class WimlibCodec(BaseCodec):
 		ret = self.dec(s, len(s), z, expanded_size)
 		if ret:
 			self.check(0, expanded_size)
-		return z[:expanded_size]
+		return buffer(z, 0, expanded_size)
 
 
 class MSCompressionCodec(BaseCodec):
 	"Performs LZX or Xpress Huffman (de)compression with MSCompression"
+	max_chunk_size = 32768 # the WIM LZX window
 	def __init__(self, codec=1):
 		try:
-			if 'linux' in sys.platform:
-				cdll.MSCompression = cdll.LoadLibrary('MSCompression.so') # we need to explicitly load
+			MSCompression = load_library('MSCompression')
 			if codec != 2:
 				logging.debug("Using MSCompression XPRESS codec")
-				self.co = cdll.MSCompression.xpress_huff_compress
-				self.dec = cdll.MSCompression.xpress_huff_decompress
+				self.co = MSCompression.xpress_huff_compress
+				self.dec = MSCompression.xpress_huff_decompress
 			else:
 				logging.debug("Using MSCompression LZX codec")
-				self.co = cdll.MSCompression.lzx_wim_compress
-				self.dec = cdll.MSCompression.lzx_wim_decompress
+				self.co = MSCompression.lzx_wim_compress
+				self.dec = MSCompression.lzx_wim_decompress
 		except:
 			raise CodecException("Can't load MSCompression library!")
 	
@@ -119,11 +146,11 @@ class MSCompressionCodec(BaseCodec):
 		cb = self.co(s, len(s), z, len(z))
 		self.check(cb, len(s), True)
 		if cb > 0 and cb < len(s):
-			return z[:cb]
+			return buffer(z, 0, cb)
 		else:
 			return s
 
-	def decompress(self, s, expanded_size):
+	def decompress(self, s, z, expanded_size):
 		if len(s) == expanded_size:
 			return s
 		cb = self.dec(s, len(s), z, len(z))
@@ -133,6 +160,7 @@ class MSCompressionCodec(BaseCodec):
 
 class RtlXpressCodec(BaseCodec):
 	"Performs Xpress Huffman (de)compression with Windows 8 NTDLL"
+	max_chunk_size = 65536 # NTDLL Xpress Huffman works on 64 KiB blocks
 	def __init__(self, codec=1):
 		if sys.platform not in ('cygwin', 'win32'):
 			raise CodecException("Can't use NTDLL on non-Windows system!")
@@ -148,7 +176,7 @@ class RtlXpressCodec(BaseCodec):
 		cb = comp_len.value
 		self.check(cb, len(s), True)
 		if cb > 0 and cb < len(s):
-			return out[:cb]
+			return buffer(out, 0, cb)
 		else:
 			return s
 		
@@ -160,180 +188,831 @@ class RtlXpressCodec(BaseCodec):
 		ret = windll.ntdll.RtlDecompressBufferEx(4, out, expanded_size, s, len(s), byref(uncomp_len), self.workspace)
 		if not ret:
 			self.check(0, expanded_size)
-		return out[:expanded_size]
+		return buffer(out, 0, expanded_size)
+
+
+
+def codec_class(compression):
+	"Selects the codec class for a compression type"
+	if compression == 1: # XPRESS
+		#~ return MSCompressionCodec
+		if sys.platform == 'win32':
+			V = sys.getwindowsversion()
+			if V.major >= 6 and V.minor >= 2: # Win 8+
+				return RtlXpressCodec
+		return WimlibCodec
+	elif compression == 2: # LZX
+		return WimlibCodec
+	return CopyCodec
+
+def check_chunk_size(compression, chunk_size):
+	"Stops if the codec for a compression type can't handle chunks of a given size"
+	cls = codec_class(compression)
+	if chunk_size > cls.max_chunk_size:
+		raise CodecException("Unsupported chunk size: %s handles up to %d KiB chunks, not %d KiB!" % (cls.__name__, cls.max_chunk_size>>10, chunk_size>>10))
+
+
+def read_chunk_table(in_stream, chunks, fmt, data_size):
+	"""Reads and decodes a whole chunk table in one pass. Returns the offsets of
+	the chunks, relative to the first one, and their compressed lengths"""
+	n = struct.calcsize(fmt)
+	s = in_stream.read((chunks-1)*n)
+	if numpy and chunks > 1:
+		offsets = numpy.empty(chunks+1, ('<u4', '<u8')[n == 8])
+		offsets[0], offsets[-1] = 0, data_size
+		offsets[1:-1] = numpy.frombuffer(s, offsets.dtype)
+		return offsets[:-1].tolist(), numpy.diff(offsets).tolist()
+	offsets = [0] + list(struct.unpack('<%d%s' % (chunks-1, fmt[1]), s)) + [data_size]
+	return offsets[:-1], map(operator.sub, offsets[1:], offsets[:-1])
+
+
+class ChunkBuffer:
+	"Preallocated input and output buffers for a chunk in flight"
+	def __init__(self, size):
+		self.input = create_string_buffer(size)
+		self.output = create_string_buffer(size + size*3/16)
+
+	def read(self, stream, size):
+		"Reads up to size bytes into the input buffer, returning a view of them"
+		if not hasattr(stream, 'readinto'):
+			return stream.read(size)
+		s = (c_char*size).from_buffer(self.input)
+		cb = stream.readinto(s)
+		if cb < size:
+			s = (c_char*cb).from_buffer(self.input)
+		return s
+
+
+class BufferPool:
+	"""Recycles the chunk buffers between reader, codecs and writer. Since the
+	reader waits for a free buffer, it also bounds the chunks in flight"""
+	def __init__(self, count, size):
+		self.size = size
+		self.limit = count # buffers allowed
+		self.count = 0 # buffers allocated
+		self.free = []
+		self.cv = threading.Condition()
+
+	def get(self):
+		"Returns a free buffer, allocating it if the limit allows, or waits for one"
+		with self.cv:
+			while not self.free and self.count >= self.limit:
+				self.cv.wait()
+			if self.free:
+				buf = self.free.pop()
+				buf.refs = 1
+				return buf
+			self.count += 1
+		buf = ChunkBuffer(self.size)
+		buf.refs = 1
+		return buf
+
+	def hold(self, buf):
+		"Adds a user to a buffer in flight: it gets recycled once all its users put it back"
+		with self.cv:
+			buf.refs += 1
+
+	def put(self, buf):
+		with self.cv:
+			buf.refs -= 1
+			if buf.refs: return
+			if self.count > self.limit: # drops the buffers beyond a reduced limit
+				self.count -= 1
+			else:
+				self.free.append(buf)
+			self.cv.notify()
+
+	def resize(self, count):
+		"Changes the number of buffers allowed"
+		with self.cv:
+			self.limit = count
+			while self.free and self.count > self.limit:
+				self.free.pop()
+				self.count -= 1
+			self.cv.notify_all()
+
+
+class ChunkMemo:
+	"""Bounded LRU cache of compressed chunks, so that identical chunks get compressed once.
+	Chunks are keyed by CRC-32 and length, and compared in full on a hit; zeroed ones skip the CRC"""
+	ZERO = 'zero'
+
+	def __init__(self, size, budget=16<<20):
+		self.zero = buffer('\0'*size)
+		self.budget = budget # input and compressed bytes kept
+		self.bytes = 0
+		self.cache = collections.OrderedDict() # {key: (input chunk, compressed chunk or None if stored)}
+		self.lock = threading.Lock()
+		self.hits = self.zero_hits = self.misses = 0
+
+	def get(self, s):
+		"Returns the key of a chunk and its compressed form, or None if not cached"
+		if len(s) == len(self.zero) and buffer(s) == self.zero:
+			key = self.ZERO
+		else:
+			key = zlib.crc32(s), len(s)
+		with self.lock:
+			item = self.cache.get(key)
+			if item is None or (key != self.ZERO and buffer(s) != item[0]):
+				self.misses += 1
+				return key, None
+			del self.cache[key]
+			self.cache[key] = item # most recently used
+			self.hits += 1
+			if key == self.ZERO:
+				self.zero_hits += 1
+		if item[1] is None:
+			return key, s
+		return key, item[1]
+
+	def put(self, key, s, z):
+		"Records the compressed form of a chunk, copying both out of their chunk buffer"
+		if z is s:
+			z = None
+		else:
+			z = str(z)
+		with self.lock:
+			if key in self.cache: return
+			self.cache[key] = str(buffer(s)), z
+			self.bytes += len(s) + len(z or '')
+			while self.bytes > self.budget:
+				s, z = self.cache.popitem(False)[1]
+				self.bytes -= len(s) + len(z or '')
+
 
+class ChunkCache:
+	"""LRU cache of decompressed chunks, shared by the readers of a CodecPool.
+	Chunks are keyed by (WIM GUID, part number, resource offset, chunk index)"""
+	def __init__(self, budget=64<<20):
+		self.budget = budget # decompressed bytes kept
+		self.bytes = 0
+		self.cache = collections.OrderedDict() # {key: decompressed chunk}
+		self.lock = threading.Lock()
+		self.hits = self.misses = 0
+		self.bytes_saved = 0 # decompressed bytes served from the cache
+
+	def get(self, key):
+		"Returns a cached chunk, or None"
+		with self.lock:
+			s = self.cache.pop(key, None)
+			if s is None:
+				self.misses += 1
+				return None
+			self.cache[key] = s # most recently used
+			self.hits += 1
+			self.bytes_saved += len(s)
+			return s
+
+	def put(self, key, s):
+		"Caches a chunk, evicting the least recently used ones beyond the budget"
+		if len(s) > self.budget: return
+		s = str(buffer(s))
+		with self.lock:
+			if key in self.cache: return
+			self.cache[key] = s
+			self.bytes += len(s)
+			while self.bytes > self.budget:
+				self.bytes -= len(self.cache.popitem(False)[1])
+
+	def hit_ratio(self):
+		if not self.hits: return 0.0
+		return self.hits/float(self.hits + self.misses)
+
+
+class StreamJob:
+	"Tracks the chunks of a single stream through the CodecMT pipeline"
+	def __init__(self, write, chunks, hash_input=None, hash_output=None):
+		self.write = write # called by the writer with (chunk_index, processed_chunk), in order
+		self.chunks = chunks # chunks the writer has to wait for
+		self.hash_input = hash_input # sha1 to update with the chunks read, if any
+		self.hash_output = hash_output # sha1 to update with the chunks written, if any
+		self.results = {} # {chunk_index: processed_chunk}
+		self.cv = threading.Condition()
+		self.done = threading.Event()
+		self.error = None
+		self.fed = 0 # chunks queued to the workers so far
+
+	def put(self, i, s):
+		"Hands a processed chunk to the writer"
+		with self.cv:
+			self.results[i] = s
+			self.cv.notify()
+
+	def get(self, i):
+		"Waits for the chunk with index i; returns None when the stream ended before it"
+		with self.cv:
+			while i not in self.results:
+				if i >= self.chunks: return None
+				self.cv.wait()
+			return self.results.pop(i)
+
+	def cut(self, chunks):
+		"Tells the writer that the reader stopped after a given number of chunks"
+		with self.cv:
+			self.chunks = chunks
+			self.cv.notify()
 
 
 class CodecMT():
-	"Performs generic multithreaded WIM resources (de)compression or copy"
-	def __init__ (self, num_threads=2, compression=1):
-		self.num_threads = num_threads
+	"""Performs generic multithreaded WIM resources (de)compression or copy.
+	Works as a pipeline: the calling thread reads and queues the chunks, the
+	worker threads (de)compress them and the writer thread emits them in order,
+	while the hasher thread takes the SHA-1 of the uncompressed chunks in order."""
+	TUNE_CHUNKS = 256 # chunks fed between two autotuning steps
+
+	def __init__ (self, num_threads=2, compression=1, chunk_size=32768, autotune=False, codec=None):
 		self.compression = compression
-		self.q_in = Queue()
-		self.q_out = PriorityQueue()
-		self.chunk = 0
+		self.chunk_size = chunk_size # uncompressed chunk size (dwCompressionSize)
+		self.autotune = autotune
+		self.active = num_threads # workers taking chunks
+		if autotune: # starts a worker per CPU, parking the ones not active
+			num_threads = max(num_threads, multiprocessing.cpu_count())
+		self.num_threads = num_threads
+		# Note: up to 16 chunks per thread in flight speeds up by 15%
+		self.per_worker = 16
+		self.depth = self.active*self.per_worker
+		self.write_buffer = 1<<20 # compressed bytes gathered before writing them out
+		self.q_in = Queue() # chunks to (de)compress, bounded by the chunk buffers
+		self.q_write = Queue() # streams to emit, in submission order
+		self.q_hash = Queue(64) # (sha1, chunk, chunk buffer) to hash, in stream order
+		self.buffers = BufferPool(self.depth, chunk_size) # chunks in flight between reader and writer
+		self.gate = threading.Condition() # parks the workers not active
+		self.busy = [0.0]*num_threads # seconds spent by each worker (de)compressing, updated by it only
+		self.busy_tuned = 0.0 # their sum at the last autotuning step
+		self.waited = 0.0 # seconds spent by the reader waiting for a free buffer
+		self.fed = 0
+		self.tuned_at = time.time()
+		self.probe = None # (samples, ratio) to classify the streams before compressing them
+		self.probed = 0
 		self.compressions_skipped = 0
-		
-		if compression == 1: # XPRESS
-			#~ self.codec = MSCompressionCodec
-			self.codec = WimlibCodec
-			if sys.platform == 'win32':
-				V = sys.getwindowsversion()
-				if V.major >= 6 and V.minor >= 2: # Win 8+
-					self.codec = RtlXpressCodec
-		elif compression == 2: # LZX
-			self.codec = WimlibCodec
-		else:
-			self.codec = CopyCodec
-			
-		for i in range(num_threads):
-			T = threading.Thread(target=self.worker_thread)
+		self.latencies = None # seconds from reading to writing each chunk, if a list
+		self.codec = codec or codec_class(compression) # a codec class other than the default one
+		self.memo = None # compressed chunks to reuse
+		self.cache = None # ChunkCache with decompressed chunks to reuse
+		if self.codec != CopyCodec:
+			self.memo = ChunkMemo(chunk_size)
+		self.pending = set() # streams fed, not yet written out
+		self.threads = []
+		self.start()
+
+	def start(self):
+		"Starts the worker, writer and hasher threads"
+		if self.threads: return
+		for i in range(self.num_threads):
+			self.threads += [threading.Thread(target=self.worker_thread, args=(i,))]
+		self.threads += [threading.Thread(target=self.writer_thread)]
+		self.threads += [threading.Thread(target=self.hasher_thread)]
+		for T in self.threads:
 			T.daemon = True
 			T.start()
+
+	def shutdown(self):
+		"Stops the worker, writer and hasher threads, once the queued streams are done"
+		if not self.threads: return
+		if self.autotune:
+			logging.debug("Autotuned codec %d: --threads=%d, %d chunks in flight", self.compression, self.active, self.depth)
+		if self.memo:
+			logging.debug("Chunk memo for codec %d: %d hits (%d zeroed), %d misses", self.compression, self.memo.hits, self.memo.zero_hits, self.memo.misses)
+		with self.gate:
+			self.active = self.num_threads
+			self.gate.notify_all()
+		for job in list(self.pending): # a stream left half fed would hold the writer forever
+			logging.debug("Cutting a stream left unfinished after %d chunks", job.fed)
+			job.cut(job.fed)
+		for i in range(self.num_threads):
+			self.q_in.put(None)
+		self.q_write.put(None)
+		self.q_hash.put(None)
+		for T in self.threads:
+			T.join()
+		self.threads = []
+
+	def _park(self, index):
+		"Waits while a worker is not active"
+		if index < self.active: return
+		with self.gate:
+			while index >= self.active:
+				self.gate.wait()
+
+	def _tune(self):
+		"""Adjusts active workers and chunks in flight from what was measured since the last step:
+		busy workers and a blocked reader call for more workers, idle workers for less;
+		a blocked reader with idle workers (slow writer) calls for more chunks in flight"""
+		now = time.time()
+		elapsed = now - self.tuned_at
+		if elapsed <= 0: return
+		total = sum(self.busy) # the workers' counters are read, never reset under them
+		busy = (total - self.busy_tuned)/(elapsed*self.active)
+		full = self.waited/elapsed
+		self.busy_tuned = total
+		self.waited, self.tuned_at = 0.0, now
+		active, per_worker = self.active, self.per_worker
+		if busy > 0.8 and full > 0.2 and active < self.num_threads:
+			active += 1
+		elif busy < 0.5 and active > 1:
+			active -= 1
+		if full > 0.2 and busy < 0.5:
+			per_worker = min(per_worker*2, 64)
+		elif full < 0.02 and per_worker > 8:
+			per_worker /= 2
+		if (active, per_worker) == (self.active, self.per_worker): return
+		with self.gate:
+			self.active, self.per_worker = active, per_worker
+			self.gate.notify_all()
+		self.depth = active*per_worker
+		self.buffers.resize(self.depth)
+		logging.debug("Autotune: %d workers, %d chunks in flight (workers busy %d%%, reader blocked %d%%)", active, self.depth, busy*100, full*100)
 	
-	def worker_thread(self):
-		output_buffer = create_string_buffer(32768+6144)
+	def worker_thread(self, index):
 		codec = self.codec(self.compression)
-		fu = [codec.compress, codec.decompress]
+		fu = [codec.compress, codec.decompress, codec.compress_group]
 		
 		while 1:
-			action, input_buffer, i, expanded_size = self.q_in.get()
-			# NOTE: passing a string buffer between threads can trash memory contents!	
-			self.q_out.put( (i, fu[action](input_buffer, output_buffer, expanded_size)) )
-			self.chunk += 1
+			self._park(index)
+			item = self.q_in.get()
+			if item is None: break
+			action, job, i, input_buffer, expanded_size, buf = item
+			# The codecs return views on the chunk buffers, valid until the writer recycles them
+			t = time.time()
+			try:
+				key = s = None
+				if action == 0 and self.memo:
+					key, s = self.memo.get(input_buffer)
+				if s is None:
+					s = fu[action](input_buffer, buf.output, expanded_size)
+					if key:
+						self.memo.put(key, input_buffer, s)
+			except Exception, e:
+				logging.debug("ERROR: codec raised %s on chunk #%d", e, i)
+				job.error = e
+				s = ''
+			self.busy[index] += time.time() - t
+			job.put(i, (s, buf))
 
-	def _copy(self, src, dst):
-		"Simple chunk by chunk copy"
+	def writer_thread(self):
+		while 1:
+			job = self.q_write.get()
+			if job is None: break
+			i = 0
+			while 1:
+				item = job.get(i)
+				if item is None: break
+				s, buf = item
+				if not job.error:
+					try:
+						job.write(i, s)
+					except Exception, e:
+						logging.debug("ERROR: writer raised %s on chunk #%d", e, i)
+						job.error = e
+					if job.hash_output:
+						self.buffers.hold(buf)
+						self.q_hash.put((job.hash_output, s, buf))
+				if self.latencies is not None:
+					self.latencies.append(time.time() - buf.stamp)
+				self.buffers.put(buf)
+				i += 1
+			job.done.set()
+
+	def hasher_thread(self):
 		while 1:
-			s = src.read(32768)
+			item = self.q_hash.get()
+			if item is None: break
+			sha1, s, buf = item
+			if sha1 is None: # all the chunks queued before are hashed
+				s.set()
+				continue
+			sha1.update(s) # hashlib releases the GIL on large buffers
+			if buf:
+				self.buffers.put(buf)
+
+	def _hashed(self):
+		"Waits for the hasher to digest the chunks queued so far"
+		done = threading.Event()
+		self.q_hash.put((None, done, None))
+		done.wait()
+
+	def _run(self, job, chunks, read_chunk):
+		"Feeds the pipeline with the chunks of a stream and waits for the writer to finish it"
+		self.pending.add(job)
+		self.q_write.put(job)
+		i = 0
+		try:
+			while i < chunks and not job.error:
+				if self.autotune:
+					t = time.time()
+					buf = self.buffers.get()
+					self.waited += time.time() - t
+					self.fed += 1
+					if self.fed % self.TUNE_CHUNKS == 0:
+						self._tune()
+				else:
+					buf = self.buffers.get()
+				if self.latencies is not None:
+					buf.stamp = time.time()
+				try:
+					item = read_chunk(i, buf)
+				except:
+					self.buffers.put(buf)
+					raise
+				if not len(item[0]):
+					self.buffers.put(buf)
+					break
+				if job.hash_input:
+					self.buffers.hold(buf)
+					self.q_hash.put((job.hash_input, item[0], buf))
+				self.q_in.put((item[1], job, i, item[0], item[2], buf))
+				i += 1
+				job.fed = i
+		finally:
+			# Even if reading failed, the writer must get past this stream
+			job.cut(i)
+			job.done.wait()
+			self.pending.discard(job)
+		if job.hash_input or job.hash_output:
+			self._hashed()
+		if job.error:
+			raise job.error
+
+	def _copy(self, src, src_size, dst):
+		"Simple chunk by chunk copy"
+		while src_size > 0:
+			s = src.read(min(self.chunk_size, src_size))
+			if not s: break
 			dst.write(s)
-			if len(s) < 32768: break
+			src_size -= len(s)
 
 	def _copy2(self, src, src_size, chunks, dst):
 		"Chunk by chunk copy with hash and size"
 		while chunks:
 			# The WIM can continue beyond the resource stream...
-			chunk_size = (32768, src_size%32768)[chunks == 1] or 32768
+			chunk_size = (self.chunk_size, src_size%self.chunk_size)[chunks == 1] or self.chunk_size
 			s = src.read(chunk_size)
-			self.sha1.update(s)
+			self.q_hash.put((self.sha1, s, None))
 			dst.write(s)
 			chunks -= 1
+		self._hashed()
+
+	def probe_stream(self, in_stream, in_size):
+		"""Compresses a few chunks sampled across a stream with fast Deflate,
+		telling if the gain makes the stream worth compressing"""
+		samples, ratio = self.probe
+		BLK = self.chunk_size
+		chunks = (in_size + BLK - 1)/BLK
+		if chunks <= samples: # too short, it gets simply compressed
+			return True
+		self.probed += 1
+		pos = in_stream.tell()
+		isize = osize = 0
+		for i in range(samples):
+			in_stream.seek(pos + (i*chunks/samples)*BLK)
+			s = in_stream.read(BLK)
+			isize += len(s)
+			osize += len(zlib.compress(s, 1))
+		in_stream.seek(pos)
+		logging.debug("Probed %d chunks, gain %.3f", samples, 1 - osize*1.0/isize)
+		return 1 - osize*1.0/isize >= ratio
 
 	# 7 INF folder: 8" w/ MultiFile|wimlib|ImageX, 9" w/ MultiChunk-2T (11" w/ 1T)
 	def compress(self, in_stream, out_stream, in_size, take_sha=False):
 		self.take_sha = take_sha
 		self.isize = in_size
 		self.sha1 = hashlib.sha1()
-		BLK = 32768
+		BLK = self.chunk_size
 		fmt = ('<I', '<Q') [in_size > 4 * (1<<30)] # > 4 GiB
-		chunks = (in_size + 32767)/32768
+		n = struct.calcsize(fmt)
+		chunks = (in_size + BLK - 1)/BLK
 		in_start_pos = in_stream.tell()
 		rsrc_start_pos = out_stream.tell()
-		if self.codec != CopyCodec:
-			out_stream.seek((chunks-1)*struct.calcsize(fmt), 1)
+		table = self.codec != CopyCodec
+		# Stores at once the streams which would not shrink
+		if table and self.probe and not self.probe_stream(in_stream, in_size):
+			self.compressions_skipped += 1
+			self._copy2(in_stream, in_size, chunks, out_stream)
+			self.osize = in_size
+			return
+		if table:
+			out_stream.seek((chunks-1)*n, 1)
 		start_pos = out_stream.tell()
-		self.chunk = chunk = 0
-		self.q_in.queue = collections.deque()
-		self.q_out = PriorityQueue()
-		if hasattr(self, 'threshold_size'):
-			self.threshold = 1
-		else:
-			self.threshold = 0
-		while chunks:
-			# Note: increasing the input queue to 16 chunk per thread speeds up by 15%
-			for i in range(self.num_threads*16):
-				s = in_stream.read(BLK)
-				if s:
-					chunk += 1
-					# (action, input_buffer, chunk_index)
-					self.q_in.put((0, s, chunk, 0))
-					if self.take_sha:
-						self.sha1.update(s)
-				else:
-					break
-			while self.chunk < chunk: # move the following to the working thread?
-				continue
-			while not self.q_out.empty():
-				chunks -= 1
-				i, s = self.q_out.get()
-				out_stream.write(s)
-				#~ logging.debug("Written chunk #%d, %d bytes", i, cb)
-				if self.codec != CopyCodec and chunks:
-					pos = out_stream.tell()
-					out_stream.seek(start_pos-chunks*struct.calcsize(fmt))
-					out_stream.write(struct.pack(fmt, pos - start_pos))
-					out_stream.seek(pos)
-				# Aborts compression if gain is < 1% after the first half input has been processed
-				# AND stream is at least 10 MiB long
-				if self.threshold:
-					if chunks == ((in_size + 32767)/32768)/self.threshold_chunks and chunks > self.threshold_size:
-						emitted = out_stream.tell() - rsrc_start_pos
-						processed = in_stream.tell() - in_start_pos
-						if 1 - emitted*1.0/processed < self.threshold_ratio:
-							self.compressions_skipped += 1
-							in_stream.seek(in_start_pos)
-							out_stream.seek(rsrc_start_pos)
-							# Restarts partial SHA-1 calculation
-							self.sha1 = hashlib.sha1()
-							self._copy2(in_stream, in_size, chunks, out_stream)
-							self.osize = in_size
-							return
+		# The chunk table is kept in memory and written once the resource is complete,
+		# while the chunks are gathered and written out in large sequential blocks
+		offsets = []
+		pending = bytearray()
+		emitted = [0] # bytes emitted
+
+		def read_chunk(i, buf):
+			return buf.read(in_stream, BLK), 0, 0
+
+		def write_chunk(i, s):
+			pending.extend(s)
+			emitted[0] += len(s)
+			if len(pending) >= self.write_buffer:
+				out_stream.write(pending)
+				del pending[:]
+			#~ logging.debug("Written chunk #%d, %d bytes", i, len(s))
+			left = chunks - i - 1
+			if table and left:
+				offsets.append(emitted[0])
+
+		self._run(StreamJob(write_chunk, chunks, (None, self.sha1)[self.take_sha]), chunks, read_chunk)
+		out_stream.write(pending)
+		if offsets:
+			out_stream.seek(rsrc_start_pos)
+			out_stream.write(struct.pack('<%d%s' % (len(offsets), fmt[1]), *offsets))
+			out_stream.seek(start_pos + emitted[0])
 		self.osize = out_stream.tell() - rsrc_start_pos # total size of the resource
 		if self.osize >= in_size: # Simply (re)copies if there's no gain
 			in_stream.seek(in_start_pos)
 			out_stream.seek(rsrc_start_pos)
-			self._copy(in_stream, out_stream)
+			self._copy(in_stream, in_size, out_stream)
 			self.osize = in_size
 
-	# 3 techniques to access chunk pointers:
-	# 1) repeatedly seek back and forward (slowest?)
-	# 2) open a new stream to read in pointers
-	# 3) read and decode all pointers in one pass
-	def decompress(self, in_stream, in_size, out_stream, out_size, take_sha=False):
+	def compress_batch(self, out_stream, buffers):
+		"""Compresses many single chunk streams, submitting them in groups of up to a chunk.
+		Returns the (offset, size) of each resource emitted, in order"""
+		groups, group, size = [], [], 0
+		for s in buffers:
+			if group and size + len(s) > self.chunk_size:
+				groups += [group]
+				group, size = [], 0
+			group += [s]
+			size += len(s)
+		if group:
+			groups += [group]
+		placed = []
+
+		def read_chunk(i, buf):
+			return groups[i], 2, 0
+
+		def write_chunk(i, zs):
+			pos = out_stream.tell()
+			out = bytearray()
+			for s, z in zip(groups[i], zs):
+				if len(z) >= len(s): # stores if there's no gain
+					z = s
+				placed.append((pos, len(z)))
+				pos += len(z)
+				out.extend(z)
+			out_stream.write(out)
+
+		self._run(StreamJob(write_chunk, len(groups)), len(groups), read_chunk)
+		return placed
+
+	def decompress(self, in_stream, in_size, out_stream, out_size, take_sha=False, key=None):
+		"""Expands a resource starting at the current stream position. If key, the
+		(GUID, part number, offset) of the resource, is given, chunks go through the cache:
+		callers give it for the resources read more than once (Metadata, byte ranges)"""
 		self.take_sha = take_sha
 		self.sha1 = hashlib.sha1()
-		BLK = 32768
 		fmt = ('<I', '<Q') [out_size > 4 * (1<<30)] # > 4 GiB
 		n = struct.calcsize(fmt)
-		chunks = (out_size + 32767)/32768
-		start_pos = in_stream.tell()
+		chunks = (out_size + self.chunk_size - 1)/self.chunk_size
 		if in_size == out_size: # copy only, 1 thread
 			self._copy2(in_stream, in_size, chunks, out_stream)
 			return
-		if self.codec != CopyCodec:
-			# Duplicating file handle to easily access chunk pointers: I/O penalties? 2ms each!
-			#~ chunks_pos = in_stream.tell()
-			cin = open(in_stream.name, 'rb')
-			cin.seek(in_stream.tell())
-			in_stream.seek((chunks-1)*n, 1)
-			prev_offset = 0
-		self.chunk = chunk = 0
-		while chunks:
-			# Multichunk approach seems faster!
-			for i in range(min(self.num_threads*16, chunks)):
-				if self.codec != CopyCodec:
-					if chunks > 1:
-						pos = in_stream.tell()
-						#~ in_stream.seek(chunks_pos)
-						new_offset = struct.unpack(fmt, cin.read(n))[0]
-						#~ new_offset = struct.unpack(fmt, in_stream.read(n))[0]
-						#~ chunks_pos += n
-						in_stream.seek(pos)
-						BLK = new_offset - prev_offset # next chunk length
-						prev_offset = new_offset
-					else:
-						BLK = in_size - (in_stream.tell() - start_pos)
-				s = in_stream.read(BLK)
-				chunk += 1
-				expanded_size = (32768, out_size%32768)[chunks == 1] or 32768
-				self.q_in.put((1, s, chunk, expanded_size))
-				chunks -= 1
-				#~ print chunk, chunks, BLK, expanded_size
-			while self.chunk < chunk:
+		table = self.codec != CopyCodec
+		if table:
+			# Reads and decodes all chunk pointers in one pass, before the chunks
+			lengths = read_chunk_table(in_stream, chunks, fmt, in_size - (chunks-1)*n)[1]
+
+		cache = table and key and self.cache
+		if cache and out_size > cache.budget: # would only churn the cache
+			cache = None
+
+		def read_chunk(i, buf):
+			BLK = self.chunk_size
+			if table:
+				BLK = lengths[i]
+			expanded_size = (self.chunk_size, out_size%self.chunk_size)[i == chunks-1] or self.chunk_size
+			if cache:
+				s = cache.get(key + (i,))
+				if s is not None: # the codecs pass on a chunk of the expanded size
+					in_stream.seek(BLK, 1)
+					return s, 1, expanded_size
+			return buf.read(in_stream, BLK), 1, expanded_size
+
+		def write_chunk(i, s):
+			out_stream.write(s)
+			if cache:
+				cache.put(key + (i,), s)
+
+		self._run(StreamJob(write_chunk, chunks, hash_output=(None, self.sha1)[self.take_sha]), chunks, read_chunk)
+
+	def read_range(self, in_stream, in_size, out_size, offset, size, key=None):
+		"""Returns size bytes at offset from a resource starting at the current stream position,
+		decompressing only the chunks which cover them (through the cache, if key is given)"""
+		if offset >= out_size or size <= 0: return ''
+		size = min(size, out_size - offset)
+		start_pos = in_stream.tell()
+		if in_size == out_size or self.codec == CopyCodec: # stored resource
+			in_stream.seek(start_pos + offset)
+			return in_stream.read(size)
+		BLK = self.chunk_size
+		fmt = ('<I', '<Q') [out_size > 4 * (1<<30)] # > 4 GiB
+		n = struct.calcsize(fmt)
+		chunks = (out_size + BLK - 1)/BLK
+		first, last = offset/BLK, (offset + size - 1)/BLK
+		# Chunk j spans from pointer j-1 (0 for the first one) to pointer j (the
+		# resource end for the last one): reads only the pointers we need
+		lo, hi = max(first-1, 0), min(last, chunks-2)
+		pointers = {}
+		if hi >= lo:
+			in_stream.seek(start_pos + lo*n)
+			for j, p in enumerate(struct.unpack('<%d%s' % (hi-lo+1, fmt[1]), in_stream.read((hi-lo+1)*n))):
+				pointers[lo+j] = p
+		pointers[-1] = 0
+		pointers[chunks-1] = in_size - (chunks-1)*n
+		base = pointers[first-1]
+		# Covering chunks are contiguous: reads them at once
+		in_stream.seek(start_pos + (chunks-1)*n + base)
+		blob = in_stream.read(pointers[last] - base)
+		pieces = bytearray()
+		cache = key and self.cache
+
+		def read_chunk(i, buf):
+			j = first + i
+			expanded_size = (BLK, out_size%BLK)[j == chunks-1] or BLK
+			if cache:
+				s = cache.get(key + (j,))
+				if s is not None:
+					return s, 1, expanded_size
+			return blob[pointers[j-1]-base: pointers[j]-base], 1, expanded_size
+
+		def write_chunk(i, s):
+			pieces.extend(s)
+			if cache:
+				cache.put(key + (first+i,), s)
+
+		self._run(StreamJob(write_chunk, last-first+1), last-first+1, read_chunk)
+		skip = offset - first*BLK
+		return str(pieces[skip: skip+size])
+
+
+def codec_process(codec, compression, conn, in_ring, out_ring, slot_size):
+	"Child process main: (de)compresses the chunks found in the shared memory slots"
+	codec = codec(compression)
+	fu = [codec.compress, codec.decompress]
+	output_buffer = create_string_buffer(slot_size)
+	while 1:
+		msg = conn.recv()
+		if msg is None: break
+		slot, action, size, expanded_size = msg
+		base = slot*slot_size
+		s = string_at(addressof(in_ring)+base, size)
+		try:
+			if action == 2: # a group of streams: expanded_size holds their lengths
+				parts, pos = [], 0
+				for cb in expanded_size:
+					parts += [s[pos:pos+cb]]
+					pos += cb
+				zs = codec.compress_group(parts, output_buffer)
+				z = ''.join([str(x) for x in zs])
+			else:
+				z = fu[action](s, output_buffer, expanded_size)
+		except Exception, e:
+			conn.send((slot, -2, str(e)))
+			continue
+		if action == 2:
+			memmove(addressof(out_ring)+base, z, len(z))
+			conn.send((slot, len(z), [len(x) for x in zs]))
+		elif z is s: # stored as is
+			conn.send((slot, -1, None))
+		else:
+			cb = len(z)
+			if not isinstance(z, str): # a view on the start of the output buffer
+				z = output_buffer
+			memmove(addressof(out_ring)+base, z, cb)
+			conn.send((slot, cb, None))
+	conn.close()
+
+
+class CodecMP(CodecMT):
+	"""Variant of CodecMT running the codecs in child processes.
+	Each worker thread drives a process, exchanging the chunks through a ring
+	of shared memory slots: only slot indexes and sizes travel on the pipe."""
+	RING = 4 # slots per process
+
+	def worker_thread(self, index):
+		SLOT = self.chunk_size + self.chunk_size*3/16
+		conn, child_conn = multiprocessing.Pipe()
+		in_ring = multiprocessing.RawArray('c', self.RING*SLOT)
+		out_ring = multiprocessing.RawArray('c', self.RING*SLOT)
+		P = multiprocessing.Process(target=codec_process, args=(self.codec, self.compression, child_conn, in_ring, out_ring, SLOT))
+		P.daemon = True
+		P.start()
+		free = collections.deque(range(self.RING))
+		pending = collections.deque() # (job, chunk_index, input_buffer, chunk_buffer, memo_key), in slot order
+		stopping = False
+
+		while 1:
+			if free and not stopping:
+				if not pending:
+					self._park(index)
+				try:
+					# Blocks only if the process has nothing to do
+					item = self.q_in.get(not pending)
+				except Empty:
+					item = False
+				if item is None:
+					stopping = True
+				elif item:
+					action, job, i, input_buffer, expanded_size, buf = item
+					key = None
+					if action == 0 and self.memo:
+						key, s = self.memo.get(input_buffer)
+						if s is not None:
+							job.put(i, (s, buf))
+							continue
+					slot = free.popleft()
+					s = input_buffer
+					if action == 2: # a group travels joined, with the parts lengths
+						s = ''.join(input_buffer)
+						expanded_size = [len(x) for x in input_buffer]
+					memmove(addressof(in_ring)+slot*SLOT, s, len(s))
+					conn.send((slot, action, len(s), expanded_size))
+					pending.append((job, i, input_buffer, buf, key))
+					continue
+			if not pending:
+				if stopping: break
 				continue
-			while not self.q_out.empty():
-				#~ chunks -= 1
-				i, s = self.q_out.get()
-				out_stream.write(s)
-				if self.take_sha:
-					self.sha1.update(s)
+			# The process serves the slots in order
+			t = time.time()
+			slot, cb, extra = conn.recv()
+			self.busy[index] += time.time() - t
+			job, i, input_buffer, buf, key = pending.popleft()
+			if cb == -2:
+				logging.debug("ERROR: codec process raised %s on chunk #%d", extra, i)
+				job.error = CodecError(extra)
+				s = ''
+			elif cb == -1:
+				s = input_buffer
+			else:
+				memmove(buf.output, addressof(out_ring)+slot*SLOT, cb)
+				s = buffer(buf.output, 0, cb)
+				if extra is not None: # splits back a group
+					zs, pos = [], 0
+					for n in extra:
+						zs += [buffer(buf.output, pos, n)]
+						pos += n
+					s = zs
+			if key and cb != -2:
+				self.memo.put(key, input_buffer, s)
+			free.append(slot)
+			job.put(i, (s, buf))
+		conn.send(None)
+		P.join()
+
+
+class CodecPool:
+	"""Keeps the multithreaded codecs alive across the archive operations, one
+	per compression type and chunk size, so that workers and codec libraries are set up once"""
+	def __init__(self, num_threads=2, workers='thread', autotune=False, cache_size=64<<20):
+		self.num_threads = num_threads
+		self.workers = workers # thread or process
+		self.autotune = autotune # lets the codecs adjust workers and chunks in flight
+		self.cache = None # decompressed chunks shared by the codecs
+		if cache_size:
+			self.cache = ChunkCache(cache_size)
+		self.codecs = {} # {(compression, chunk_size): CodecMT}
+		self.lock = threading.Lock()
+
+	def get(self, compression, chunk_size=32768):
+		"Returns the running codec for a compression type, starting it if needed"
+		key = compression, chunk_size
+		with self.lock:
+			if key not in self.codecs:
+				check_chunk_size(compression, chunk_size)
+				if self.workers == 'process':
+					self.codecs[key] = CodecMP(self.num_threads, compression, chunk_size, self.autotune)
+				else:
+					self.codecs[key] = CodecMT(self.num_threads, compression, chunk_size, self.autotune)
+				self.codecs[key].cache = self.cache
+				logging.debug("Started %s codec pool for compression type %d, %d bytes chunks", self.workers, compression, chunk_size)
+			return self.codecs[key]
+
+	def start(self, *compressions):
+		"Starts in advance the codecs for the given compression types"
+		for compression in compressions:
+			self.get(compression)
+		return self
+
+	def shutdown(self):
+		"Stops all the codecs"
+		with self.lock:
+			for codec in self.codecs.values():
+				codec.shutdown()
+			self.codecs = {}
+		if self.cache and self.cache.hits:
+			logging.debug("Chunk cache: %d hits, %d misses (%.1f%%), %d bytes not decompressed again", self.cache.hits, self.cache.misses, self.cache.hit_ratio()*100, self.cache.bytes_saved)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.shutdown()
+
+
+def get_codec(opts, compression, chunk_size=32768):
+	"Returns the pooled codec for a compression type, setting up a pool in the options if missing"
+	if not getattr(opts, 'pool', None):
+		opts.pool = CodecPool(opts.num_threads, getattr(opts, 'workers', 'thread'), getattr(opts, 'autotune', False), getattr(opts, 'cache_size', 64<<20))
+	return opts.pool.get(compression, chunk_size)
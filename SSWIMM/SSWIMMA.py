@@ -48,25 +48,18 @@ def append(opts, args):
 
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
+	codec.probe = opts.probe
 
-	if opts.threshold:
-		Codecs.Codec.threshold_size = opts.threshold.size
-		Codecs.Codec.threshold_ratio = opts.threshold.ratio
-		Codecs.Codec.threshold_ratio = opts.threshold.ratio
-
-	offset_table = get_offsettable(out, wim)
-	images = get_images(out, wim)
+	offset_table, images = load_offsettable(out, wim)
 	
-	for o in offset_table.values():
-		if o.rhOffsetEntry.bFlags & 2: # skips image resource
-			continue
-		RefCounts[o.bHash] = (o.rhOffsetEntry.liOffset, o.rhOffsetEntry.liOriginalSize, o.rhOffsetEntry.ullSize, o.dwRefCount, o.rhOffsetEntry.bFlags)
+	for r in offset_table.iterresources(): # skips image resources
+		RefCounts[r[0]] = r[1:] # offset, size, compressed size, count, flags
 
 	security = make_securityblock()
 
 	print "Collecting new files..."
-	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list)
+	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list, opts.scan_threads)
 
 	# Flags the header for writing in progress
 	wim.dwFlags |= 0x40
@@ -76,7 +69,7 @@ def append(opts, args):
 	out.seek(0, 2)
 	
 	print "Packing contents..."
-	totalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime)
+	totalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime, codec, get_hash_cache(opts))
 
 	sd_raw = security.tostr()
 
@@ -96,9 +89,9 @@ def append(opts, args):
 
 	meta_size = meta.tell() # uncomp/comp size
 	meta.seek(0)
-	Codecs.Codec.compress(meta, out, meta_size, True)
+	codec.compress(meta, out, meta_size, True)
 
-	crc = Codecs.Codec.sha1.digest()
+	crc = codec.sha1.digest()
 	if crc in offset_table:
 		print "No files to add, image is equal to another one!"
 		logging.debug("Image already stored, merging the Metadata!")
@@ -112,7 +105,7 @@ def append(opts, args):
 	wim.rhOffsetTable.liOffset = out.tell()
 	logging.debug("Writing Offset table @0x%08X", wim.rhOffsetTable.liOffset)
 	if not image_already_stored:
-		images += [make_offsetimage(Codecs.Codec, image_start)]
+		images += [make_offsetimage(codec, image_start)]
 	else:
 		for i in range(len(images)):
 			if images[i].bHash == crc:
@@ -140,4 +133,6 @@ def append(opts, args):
 	
 	finalize_wimheader(wim, out)
 
+	print_probe(codec)
+	print_memo(codec)
 	print_timings(StartTime, StopTime)
@@ -0,0 +1,280 @@
+'''
+SWIMMB.PY - Part of Super Simple WIM Manager
+Codecs benchmark module
+'''
+
+VERSION = '0.29'
+
+COPYRIGHT = '''Copyright (C)2012-2013, by maxpat78. GNU GPL v2 applies.
+This free software manages MS WIM Archives WITH ABSOLUTELY NO WARRANTY!'''
+
+import Codecs
+import WIMArchive
+import hashlib
+import io
+import logging
+import random
+import struct
+import sys
+import time
+import zlib
+
+# Backends to measure: (name, compression type, codec class, library required)
+BENCH_CODECS = [
+('copy', 0, Codecs.CopyCodec, None),
+('wimlib-xpress', 1, Codecs.WimlibCodec, 'wimlib'),
+('wimlib-lzx', 2, Codecs.WimlibCodec, 'wimlib'),
+('mscomp-xpress', 1, Codecs.MSCompressionCodec, 'MSCompression'),
+('mscomp-lzx', 2, Codecs.MSCompressionCodec, 'MSCompression'),
+('rtl-xpress', 1, Codecs.RtlXpressCodec, None)
+]
+
+WORDS = '''the of and to in is that for it as was with be by on not he this are or his from at which but have an they you
+were her she there one all we their has been had if more when will would who so no file folder image system windows data
+stream chunk resource offset table header archive compression directory security descriptor volume driver service'''.split()
+
+
+def codec_available(cls):
+	"Tells if a codec class can run here, without loading it into the workers"
+	if cls == Codecs.RtlXpressCodec:
+		return Codecs.codec_class(1) == cls
+	for name, compression, klass, library in BENCH_CODECS:
+		if klass == cls and library:
+			try:
+				Codecs.load_library(library)
+			except Exception:
+				return False
+	return True
+
+def make_text(size, seed=1):
+	"Pseudo English text lines"
+	r = random.Random(seed)
+	lines, n = [], 0
+	while n < min(size, 1<<20):
+		s = ' '.join([r.choice(WORDS) for i in range(r.randint(4, 16))]).capitalize() + '.\r\n'
+		lines += [s]
+		n += len(s)
+	s = ''.join(lines)
+	return (s * (size/len(s) + 1))[:size]
+
+def make_binary(size, seed=2):
+	"Executable-like data: opcodes, small integers, relocated pointers and padding"
+	r = random.Random(seed)
+	opcodes = [chr(r.getrandbits(8)) for i in range(48)]
+	parts, n, base = [], 0, 0x401000
+	while n < size:
+		k = r.randint(0, 9)
+		if k < 5:
+			s = ''.join([r.choice(opcodes) for i in range(r.randint(1, 12))])
+		elif k < 8:
+			s = struct.pack('<I', base + r.randint(0, 1<<12)*4)
+		elif k < 9:
+			s = struct.pack('<H', r.randint(0, 255))
+		else:
+			s = '\0' * r.choice((4, 8, 16, 64))
+		parts += [s]
+		n += len(s)
+	return ''.join(parts)[:size]
+
+def make_compressed(size, seed=3):
+	"Random bytes, like zipped or media contents"
+	r = random.Random(seed)
+	n = (size + 7)/8
+	return struct.pack('<%dQ' % n, *[r.getrandbits(64) for i in xrange(n)])[:size]
+
+def make_zeros(size, seed=0):
+	return '\0' * size
+
+CORPORA = [('text', make_text), ('binary', make_binary), ('compressed', make_compressed), ('zeros', make_zeros)]
+
+
+def percentile(values, p):
+	"Returns the p-th percentile (0-100) of a sorted list"
+	if not values: return 0
+	return values[int(round(p/100.0*(len(values)-1)))]
+
+def bench_codec(codec, corpus, chunks):
+	"""Compresses a corpus as streams of a given number of chunks, then decompresses
+	and verifies them. Returns compression and decompression MB/s, compression ratio
+	and the sorted per-chunk compression latencies"""
+	stream_size = chunks * codec.chunk_size
+	src, dst, out = io.BytesIO(corpus), io.BytesIO(), io.BytesIO()
+	streams = [] # (offset, size, compressed size)
+	codec.latencies = []
+	t = time.time()
+	for pos in range(0, len(corpus), stream_size):
+		size = min(stream_size, len(corpus) - pos)
+		offset = dst.tell()
+		codec.compress(src, dst, size)
+		streams += [(offset, size, codec.osize)]
+		src.seek(pos + size)
+	ct = time.time() - t
+	latencies = sorted(codec.latencies)
+	codec.latencies = None
+	t = time.time()
+	for offset, size, csize in streams: # a single pass, through the cache if any (--cache-size)
+		dst.seek(offset)
+		codec.decompress(dst, csize, out, size, key=(id(corpus), chunks, offset))
+	dt = time.time() - t
+	if hashlib.sha1(out.getvalue()).digest() != hashlib.sha1(corpus).digest():
+		raise Codecs.CodecError("round trip mismatch")
+	MB = len(corpus)/float(1<<20)
+	return MB/max(ct, 1e-6), MB/max(dt, 1e-6), sum([x[2] for x in streams])/float(len(corpus)), latencies
+
+def deep_size(objs):
+	"Returns the bytes taken by a list of objects and by what they refer to, counting once the shared ones"
+	seen, size, todo = set(), 0, list(objs)
+	while todo:
+		o = todo.pop()
+		if id(o) in seen: continue
+		seen.add(id(o))
+		size += sys.getsizeof(o)
+		if type(o) in (type([]), type(()), type(set())):
+			todo += list(o)
+		elif type(o) == type({}):
+			todo += o.keys() + o.values()
+		if hasattr(o, '__dict__'):
+			todo += [o.__dict__]
+		for cls in type(o).__mro__:
+			for name in getattr(cls, '__slots__', ()):
+				if hasattr(o, name):
+					todo += [getattr(o, name)]
+	return size
+
+def sample_records():
+	"Returns a raw DIRENTRY, STREAMENTRY and offset table entry, like those of an image"
+	e = WIMArchive.DirEntry()
+	e.FileName = u'setupapi.dev.20131011_120000.log'.encode('utf-16le')
+	e.wFileNameLength = len(e.FileName)
+	e.liLength = 0x66 + e.wFileNameLength + 2
+	e.liLength += (8 - (e.liLength%8) & 7)
+	e.dwAttributes, e.liLastWriteTime, e.bHash = 0x20, 130000000000000000, hashlib.sha1('d').digest()
+	se = WIMArchive.StreamEntry()
+	se.StreamName = u'Zone.Identifier'.encode('utf-16le')
+	se.wStreamNameLength, se.bHash = len(se.StreamName), hashlib.sha1('s').digest()
+	o = WIMArchive.OffsetTableEntry()
+	o.rhOffsetEntry.liOffset, o.rhOffsetEntry.ullSize, o.rhOffsetEntry.liOriginalSize = 1<<30, 4000, 9000
+	o.dwRefCount, o.usPartNumber, o.bHash = 1, 1, hashlib.sha1('o').digest()
+	return [(WIMArchive.DirEntry, e.tostr()), (WIMArchive.StreamEntry, se.tostr()), (WIMArchive.OffsetTableEntry, o.tostr())]
+
+def bench_records(count=100000):
+	"Measures time and memory to parse and serialize DIRENTRYs, STREAMENTRYs and offset table entries"
+	print "%-17s %9s %11s %11s %13s" % ('record', 'count', 'parse us', 'tostr us', 'bytes each')
+	for cls, raw in sample_records():
+		t = time.time()
+		records = [cls(raw) for i in xrange(count)]
+		pt = time.time() - t
+		if cls == WIMArchive.DirEntry:
+			for i, e in enumerate(records): # what get_direntries adds
+				e._pos, e._parent, e.alt_data_streams = i*len(raw), 0, []
+		size = deep_size(records) - sys.getsizeof(records)
+		for e in records: # names are written encoded, as captured
+			if cls == WIMArchive.DirEntry:
+				e.FileName = e.FileName.encode('utf-16le')
+			elif cls == WIMArchive.StreamEntry:
+				e.StreamName = e.StreamName.encode('utf-16le')
+		t = time.time()
+		for e in records:
+			e.tostr()
+		st = time.time() - t
+		print "%-17s %9d %11.2f %11.2f %13d" % (cls.__name__, count, pt*1e6/count, st*1e6/count, size/count)
+		del records
+
+class ZlibCodec(Codecs.BaseCodec):
+	"Stand-in codec storing the chunks zlib can't shrink, as the WIM codecs do"
+	def compress(self, s, z, expanded_size):
+		c = zlib.compress(str(buffer(s)), 1)
+		if len(c) < len(s): return c
+		return s
+
+	def decompress(self, s, z, expanded_size):
+		if len(s) == expanded_size: return s
+		return zlib.decompress(str(buffer(s)))
+
+def check_cache(chunk_size=32768):
+	"""Reads twice through the chunk cache a resource with a stored (incompressible)
+	chunk between compressed ones, with both backends: the second reads, served
+	from the cache, must give back the same data as the first"""
+	r = random.Random(4)
+	data = 'a'*chunk_size + ''.join([chr(r.getrandbits(8)) for i in xrange(chunk_size)]) + 'b'*(chunk_size-1000)
+	start, length = chunk_size - 100, chunk_size + 200 # across the stored chunk
+	failed = 0
+	for cls in (Codecs.CodecMT, Codecs.CodecMP):
+		codec = cls(2, 1, chunk_size, False, ZlibCodec)
+		codec.cache = Codecs.ChunkCache()
+		try:
+			src = io.BytesIO()
+			codec.compress(io.BytesIO(data), src, len(data))
+			results = []
+			for i in range(2):
+				for what in ('decompress', 'read_range'):
+					src.seek(0)
+					try:
+						if what == 'decompress':
+							dst = io.BytesIO()
+							codec.decompress(src, codec.osize, dst, len(data), key=('check',))
+							ok = dst.getvalue() == data
+						else:
+							ok = codec.read_range(src, codec.osize, len(data), start, length, key=('check',)) == data[start:start+length]
+					except Exception, e:
+						logging.debug("Cached %s with %s failed: %s", what, cls.__name__, e)
+						ok = False
+					results += [ok]
+					print "%-9s %-10s pass %d: %s" % (cls.__name__, what, i+1, ('FAILED', 'OK')[ok])
+			failed += results.count(False)
+		finally:
+			codec.shutdown()
+	return failed
+
+def bench(opts, args):
+	"""Runs every available codec through CodecMT (or CodecMP) on the standard corpora,
+	for the thread counts and chunks per stream given in args (comma separated lists),
+	followed by the corpus size in MiB. With 'records' as first argument, measures the
+	image records instead (bench_records), as many as the following one; with 'cache',
+	checks the chunk cache gives back what it was given (check_cache)"""
+	if args[0:1] == ['records']:
+		return bench_records(int((args[1:2] or ['100000'])[0]))
+	if args[0:1] == ['cache']:
+		if check_cache():
+			sys.exit(1)
+		return
+	threads = [int(x) for x in (args[0:1] or ['1,2,4'])[0].split(',')]
+	chunk_counts = [int(x) for x in (args[1:2] or ['1,16,256'])[0].split(',')]
+	size = int((args[2:3] or ['8'])[0]) << 20
+	chunk_size = getattr(opts, 'chunk_size', 32768)
+	workers = getattr(opts, 'workers', 'thread')
+	autotune = getattr(opts, 'autotune', False)
+	cache_size = getattr(opts, 'cache_size', 64<<20)
+
+	print "Generating %d MiB corpora..." % (size>>20)
+	corpora = [(name, fu(size)) for name, fu in CORPORA]
+
+	print "%-14s %-10s %7s %7s %9s %9s %6s %8s %8s %8s" % ('codec', 'corpus', 'threads', 'chunks', 'C MB/s', 'D MB/s', 'ratio', 'p50 ms', 'p90 ms', 'p99 ms')
+	for name, compression, cls, library in BENCH_CODECS:
+		if not codec_available(cls):
+			print "%-14s not available, skipped" % name
+			continue
+		if chunk_size > cls.max_chunk_size:
+			print "%-14s takes up to %d KiB chunks, skipped" % (name, cls.max_chunk_size>>10)
+			continue
+		for num_threads in threads:
+			if workers == 'process':
+				codec = Codecs.CodecMP(num_threads, compression, chunk_size, autotune, cls)
+			else:
+				codec = Codecs.CodecMT(num_threads, compression, chunk_size, autotune, cls)
+			if cache_size:
+				codec.cache = Codecs.ChunkCache(cache_size)
+			try:
+				for corpus_name, corpus in corpora:
+					for chunks in chunk_counts:
+						cs, ds, ratio, L = bench_codec(codec, corpus, chunks)
+						print "%-14s %-10s %7d %7d %9.1f %9.1f %6.3f %8.3f %8.3f %8.3f" % (name, corpus_name, num_threads, chunks,
+						cs, ds, ratio, percentile(L, 50)*1000, percentile(L, 90)*1000, percentile(L, 99)*1000)
+						logging.debug("Benchmarked %s on %s, %d threads, %d chunks per stream: %.1f/%.1f MB/s, ratio %.3f",
+						name, corpus_name, num_threads, chunks, cs, ds, ratio)
+			finally:
+				codec.shutdown()
+
+
+if __name__ == '__main__':
+	bench(None, sys.argv[1:])
@@ -17,6 +17,7 @@ import hashlib
 import logging
 import os
 import Queue
+import stat
 import sys
 import tempfile
 import time
@@ -30,12 +31,12 @@ from WIMArchive import *
 from StringIO import StringIO
 
 
-def make_wimheader(compress=1):
+def make_wimheader(compress=1, chunk_size=0x8000):
 	wim = WIMHeader(208*'\0')
 	wim.ImageTag = 'MSWIM\0\0\0'
 	wim.cbSize = 0xD0
 	wim.dwVersion = 0x00010D00 # 1.13
-	wim.dwCompressionSize = 0x8000
+	wim.dwCompressionSize = chunk_size
 	if compress == 1:
 		wim.dwFlags = 2 | 0x20000 # XPRESS compressed
 	elif compress == 2:
@@ -49,28 +50,36 @@ def make_wimheader(compress=1):
 	wim.usPartNumber = 1
 	wim.usTotalParts = 1
 	wim.dwImageCount = 1
-	wim.rhOffsetTable = DiskResHdr(64*'\0')
-	wim.rhXmlData = DiskResHdr(64*'\0')
-	wim.rhBootMetadata = DiskResHdr(64*'\0')
-	wim.rhIntegrity = DiskResHdr(64*'\0')
+	wim.rhOffsetTable = DiskResHdr()
+	wim.rhXmlData = DiskResHdr()
+	wim.rhBootMetadata = DiskResHdr()
+	wim.rhIntegrity = DiskResHdr()
 	wim.bUnused = 60*'\0'
 	return wim
 
-def make_direntry(pathname, security, isroot=0, srcdir=None):
-	e = DirEntry(255*'\0')
-	if len(pathname) < 255:
-		# In Linux we don't want to follow broken links!
-		st = os.lstat(pathname)
-	else:
-		st = os.lstat('\\\\?\\'+os.path.abspath(pathname))
+def make_direntry(pathname, security, isroot=0, srcdir=None, st=None):
+	"Makes the DIRENTRY of a file or folder; st, its os.lstat result, is taken if not given"
+	e = DirEntry()
+	if not st:
+		if len(pathname) < 255:
+			# In Linux we don't want to follow broken links!
+			st = os.lstat(pathname)
+		else:
+			st = os.lstat('\\\\?\\'+os.path.abspath(pathname))
 	e.FileSize = st.st_size
+	e.stamp = st.st_size, st.st_mtime, st.st_ctime, st.st_ino # what the hash cache trusts
 	if sys.platform in ('win32', 'cygwin'):
 		e.dwAttributes = windll.kernel32.GetFileAttributesW(pathname)
 		if e.dwAttributes == -1:
 			logging.debug("GetFileAttributesW returned -1 on %s", pathname)
 			e.dwAttributes = 0x20
-	e.dwSecurityId = security.addobject(pathname)
-	if os.path.isfile(pathname):
+	if security is not None: # else the caller indexes the SD
+		e.dwSecurityId = security.addobject(pathname)
+	if stat.S_ISLNK(st.st_mode):
+		is_file = os.path.isfile(pathname) # looks at the target
+	else:
+		is_file = stat.S_ISREG(st.st_mode)
+	if is_file:
 		e.dwAttributes = 0x20
 	else:
 		e.dwAttributes |= 0x10
@@ -99,16 +108,16 @@ def make_direntry(pathname, security, isroot=0, srcdir=None):
 	e.liLength += (8 - (e.liLength%8) & 7) # QWORD padding
 	e.bHash = 0
 	# Handles reparse points (directory junctions and symbolic links to files/dirs)
-	if IsReparsePoint(pathname):
+	if IsReparsePoint(pathname, st):
 		e.dwAttributes |= 0x400
-		e.dwReparseReserved = GetReparsePointTag(pathname)
+		e.dwReparseReserved = GetReparsePointTag(pathname, st)
 		isRelative, e.sReparseData = GetReparsePointData(pathname, srcdir)
 		if isRelative and e.dwReparseReserved == 0xA000000C: # Symlink
 			e.dwHardLink = 0x10000
 		e.FileSize = len(e.sReparseData)
 		logging.debug("Parsed %s as Reparse point type %X", pathname, e.dwReparseReserved) 
 	# Stores hard link (nFileIndex)
-	tu = IsHardlinkedFile(pathname)
+	tu = IsHardlinkedFile(pathname, st)
 	if type(tu) == type(()):
 		e.dwReparseReserved = tu[0] # nFileIndexLow
 		e.dwHardLink = tu[1] # nFileIndexHigh
@@ -116,7 +125,7 @@ def make_direntry(pathname, security, isroot=0, srcdir=None):
 	# Handles alternate data streams on Windows
 	e.alt_data_streams = {}
 	if not (e.dwAttributes & 0x10):
-		e.alt_data_streams = get_ads(pathname)
+		e.alt_data_streams = get_ads(pathname, st)
 		e.wStreams = len(e.alt_data_streams)
 	return e
 
@@ -126,125 +135,448 @@ def make_securityblock():
 	e.dwNumEntries = 0
 	return e
 
-def make_direntries(directory, security, excludes=None):
-	def is_excluded(s, excludes):
-		i_pname = s[s.find('\\'):] # pathname how it will be inside the image
-		# if the excluded item is a dir, we want subcontents excluded also! (x+\*)
-		return True in map(lambda x:fnmatch.fnmatch(i_pname, x) or fnmatch.fnmatch(i_pname, x+'\\*'), excludes)
+class TreeScanner:
+	"""Lists the folders of a tree and makes their DIRENTRYs in a pool of threads, running ahead
+	of the walk, so that stat latencies overlap. Folders are visited as os.walk does, except that
+	excluded folders and reparse points are not descended; the SDs are read in the threads but
+	indexed by the walk, in capture order"""
+	def __init__(self, directory, security, excludes, num_threads=8):
+		self.directory = directory
+		self.security = security
+		self.is_excluded = make_exclusion_matcher(excludes)
+		self.q = Queue.Queue()
+		self.results = {} # {folder: scan result}
+		self.done = threading.Condition()
+		self.closed = False
+		self.threads = []
+		for i in range(max(1, num_threads)):
+			t = threading.Thread(target=self.scan_thread)
+			t.daemon = True
+			t.start()
+			self.threads += [t]
+
+	def scan_thread(self):
+		while 1:
+			item = self.q.get()
+			if item is None: break
+			if self.closed: continue
+			root, st = item
+			try:
+				r = self.scan(root, st)
+			except:
+				r = sys.exc_info()
+			self.done.acquire()
+			self.results[root] = r
+			self.done.notifyAll()
+			self.done.release()
+
+	def submit(self, root, st=None):
+		self.q.put((root, st))
+
+	def get(self, root):
+		"Waits for a folder scanned, returning (skipped, root DIRENTRY, files, folders, subfolders to walk) or None"
+		self.done.acquire()
+		while root not in self.results:
+			self.done.wait()
+		r = self.results.pop(root)
+		self.done.release()
+		if type(r) == type(()) and len(r) == 3 and isinstance(r[1], BaseException):
+			raise r[0], r[1], r[2]
+		return r
+
+	def close(self):
+		self.closed = True
+		for t in self.threads:
+			self.q.put(None)
+		for t in self.threads:
+			t.join()
+
+	def make(self, pname, isroot=0, st=None):
+		e = make_direntry(pname, None, isroot, self.directory, st)
+		e.sd = self.security.getsd(pname)
+		return e
+
+	def scan(self, root, root_st=None):
+		"""Lists a folder like os.walk, making a DIRENTRY for each item not excluded. Every item
+		is stat'ed once, unless it is a symbolic link"""
+		if IsReparsePoint(root, root_st) or self.is_excluded(root):
+			return True, None, [], [], []
+		try:
+			names = os.listdir(root)
+		except os.error:
+			return None
+		dirs, files, stats = [], [], {}
+		for name in names:
+			pname = os.path.join(root, name)
+			try:
+				stats[name] = os.lstat(pname)
+			except os.error:
+				stats[name] = None # the long pathnames, i.e., are stat'ed later
+			st = stats[name]
+			if st and not stat.S_ISLNK(st.st_mode):
+				is_dir = stat.S_ISDIR(st.st_mode)
+			else: # a link is a folder if its target is
+				is_dir = os.path.isdir(pname)
+			if is_dir:
+				dirs += [name]
+			else:
+				files += [name]
+		subdirs = [] # like os.walk, doesn't descend into links to folders; nor into excluded ones
+		for x in dirs:
+			pname, st = os.path.join(root, x), stats[x]
+			if (st and not stat.S_ISLNK(st.st_mode)) or (not st and not os.path.islink(pname)):
+				if not self.is_excluded(pname):
+					subdirs += [pname]
+					self.submit(pname, st)
+		root_entry = None
+		if root == self.directory:
+			root_entry = self.make(root, 1, root_st)
+		items = []
+		for names in (files, dirs):
+			items += [[]]
+			for item in names:
+				pname = os.path.join(root, item)
+				if self.is_excluded(pname):
+					items[-1] += [(pname, None)]
+					continue
+				if len(item) > 255 and '\\\\?\\' not in pname:
+					pname = '\\\\?\\' + os.path.abspath(pname) # access pathnames > 255
+				items[-1] += [(pname, self.make(pname, st=stats[item]))]
+		return False, root_entry, items[0], items[1], subdirs
+
+def make_direntries(directory, security, excludes=None, num_threads=8):
 	directory = os.path.normpath(unicode(directory))
 	direntries = []
 	total_input_bytes = 0
 
+	def add(e):
+		e.dwSecurityId = security.addsd(e.sd)
+		del e.sd
+		direntries.append(e)
+
 	# root DIRENTRY offset relative to Metadata resource start
 	pos = 0 # relative offset of the next subdir content
 	subdirs = OrderedDict() # {parent folder: childs offset}
-	for root, dirs, files in os.walk(directory):
-		logging.debug("root is now %s", root)
-		if IsReparsePoint(root): # this isn't a true directory
-			logging.debug("Stopped descending into reparse point '%s'", root)
-			continue
-		if excludes and is_excluded(root, excludes):
-			logging.debug("Excluded root %s", root)
-			continue
-		if root == directory:
-			direntries += [make_direntry(root,security,1,directory)]
-			logging.debug("Made Root DIRENTRY %s", root)
-			direntries += [DirEntry(255*'\0')] # a null QWORD marks the end of folder
-			pos += direntries[-2].liLength + 8
-			logging.debug("Made NULL QWORD (end of root)")
-		for item in files:
-			if root not in subdirs:
-				subdirs[root] = pos
-			pname = os.path.join(root, item)
-			if excludes and is_excluded(pname, excludes):
-				logging.debug("Excluded file %s", pname)
+	scanner = TreeScanner(directory, security, excludes, num_threads)
+	scanner.submit(directory)
+	stack = [directory]
+	try:
+		while stack:
+			root = stack.pop()
+			r = scanner.get(root)
+			if r is None: continue
+			skipped, root_entry, files, dirs, walk = r
+			stack += reversed(walk)
+			logging.debug("root is now %s", root)
+			if skipped:
+				logging.debug("Skipped root %s (reparse point or excluded)", root)
 				continue
-			if len(item) > 255 and '\\\\?\\' not in pname:
-				pname = '\\\\?\\' + os.path.abspath(pname) # access pathnames > 255
-			direntries += [make_direntry(pname, security, srcdir=directory)]
-			pos += direntries[-1].liLength
-			total_input_bytes += direntries[-1].FileSize
-			if direntries[-1].alt_data_streams:
-				for ads in direntries[-1].alt_data_streams:
-					pos += ads.length()
-					total_input_bytes += ads.FileSize
-			logging.debug("Made File DIRENTRY %s", pname)
-		for item in dirs:
-			if root not in subdirs:
+			if root_entry is not None:
+				add(root_entry)
+				logging.debug("Made Root DIRENTRY %s", root)
+				direntries += [DirEntry()] # a null QWORD marks the end of folder
+				pos += direntries[-2].liLength + 8
+				logging.debug("Made NULL QWORD (end of root)")
+			for pname, e in files:
+				if root not in subdirs:
+					subdirs[root] = pos
+				if e is None:
+					logging.debug("Excluded file %s", pname)
+					continue
+				add(e)
+				pos += e.liLength
+				total_input_bytes += e.FileSize
+				if e.alt_data_streams:
+					for ads in e.alt_data_streams:
+						pos += ads.length()
+						total_input_bytes += ads.FileSize
+				logging.debug("Made File DIRENTRY %s", pname)
+			for pname, e in dirs:
+				if root not in subdirs:
+					subdirs[root] = pos
+				if e is None:
+					logging.debug("Excluded folder %s", pname)
+					continue
+				add(e)
+				logging.debug("Made Folder DIRENTRY %s", pname)
+				pos += e.liLength
+				total_input_bytes += e.FileSize
+			if root not in subdirs: # an empty folder must point to the following NULL QWORD
 				subdirs[root] = pos
-			pname = os.path.join(root, item)
-			if excludes and is_excluded(pname, excludes):
-				logging.debug("Excluded folder %s", pname)
-				continue
-			if len(item) > 255 and '\\\\?\\' not in pname:
-				pname = '\\\\?\\' + os.path.abspath(pname) # access pathnames > 255
-			direntries += [make_direntry(pname,security,srcdir=directory)]
-			logging.debug("Made Folder DIRENTRY %s", item)
-			pos += direntries[-1].liLength
-			total_input_bytes += direntries[-1].FileSize
-		if root not in subdirs: # an empty folder must point to the following NULL QWORD
-			subdirs[root] = pos
-		direntries += [DirEntry(255*'\0')]
-		pos += 8
-		logging.debug("Made NULL QWORD (end of folder)")
+			direntries += [DirEntry()]
+			pos += 8
+			logging.debug("Made NULL QWORD (end of folder)")
+	finally:
+		scanner.close()
 	for it in subdirs:
 		subdirs[it] += security.length() # fix final offset relative to Security Data object
 	return pos, direntries, subdirs, total_input_bytes
 
-def make_fileresources(out, comp, entries, refcounts, total_input_bytes, start_time):
-	"Packs the files content into the image, discarding duplicates according to their SHA-1"
+def read_resource(src, size):
+	"Reads the whole content of a small file resource"
+	if type(src) in (type(''), type(u'')):
+		fp = open(src, 'rb')
+		s = fp.read(size)
+		fp.close()
+		return s
+	return src.read(size)
+
+class SmallResources:
+	"Packs single chunk file resources in batches, keeping several of them in flight"
+	def __init__(self, out, refcounts, codec, limit=4<<20):
+		self.out = out
+		self.refcounts = refcounts
+		self.codec = codec
+		self.limit = limit # bytes to collect before compressing
+		self.reset()
+
+	def reset(self):
+		self.entries, self.buffers, self.dups = [], [], []
+		self.hashes = {} # {sha-1: entry} for the batched resources
+		self.size = 0
+
+	def add(self, e, s, crc):
+		"Queues a resource, or records it as a duplicate of a queued one"
+		if crc in self.hashes:
+			logging.debug("Discarded %s (hash collision)", e.SrcPathname)
+			self.dups += [(e, crc)]
+			return
+		e.bHash = crc
+		self.hashes[crc] = e
+		self.entries += [e]
+		self.buffers += [s]
+		self.size += len(s)
+		if self.size >= self.limit:
+			self.flush()
+
+	def flush(self):
+		"Compresses the batched resources and updates their offsets and reference counts"
+		if not self.entries: return
+		placed = self.codec.compress_batch(self.out, self.buffers)
+		for e, s, (offset, size) in zip(self.entries, self.buffers, placed):
+			e.Offset, e.cFileSize = offset, size
+			self.refcounts[e.bHash] = (e.Offset, len(s), e.cFileSize, 1, e.bCompressed)
+			logging.debug("Wrote content from %s @%08X", e.SrcPathname, e.Offset)
+		for e, crc in self.dups:
+			h = self.refcounts[crc]
+			self.refcounts[crc] = (h[0], h[1], h[2], h[3]+1, h[4])
+			e.Offset = h[0]
+			e.bHash = crc
+		self.reset()
+
+class HashCache:
+	"""Persistent SHA-1 of the captured files, trusted while a file keeps its pathname, size,
+	modification and change times and inode. Hashes of files modified in the last seconds
+	before the capture are not recorded, since a later change could keep the same times;
+	records not used by a capture are dropped after MAX_AGE captures"""
+	MAGIC = 'SSWIMMHC\1\0'
+	RECORD = struct.Struct('<QddQ20sBH') # size, mtime, ctime, inode, sha-1, age, pathname length
+	MAX_AGE = 4
+	RACY = 2 # seconds
+
+	def __init__(self, pathname):
+		self.pathname = pathname
+		self.records = {} # {pathname: (size, mtime, ctime, inode, sha-1, age)}
+		self.used = set()
+		self.started = time.time()
+		self.hits = self.misses = 0
+		try:
+			s = open(pathname, 'rb').read()
+		except IOError:
+			return
+		if not s.startswith(self.MAGIC):
+			logging.debug("Hash cache %s not recognized, ignored", pathname)
+			return
+		i, n = len(self.MAGIC), self.RECORD.size
+		try:
+			while i < len(s):
+				r = self.RECORD.unpack_from(s, i)
+				i += n
+				self.records[s[i: i+r[6]].decode('utf8')] = r[:6]
+				i += r[6]
+		except struct.error:
+			logging.debug("Hash cache %s truncated", pathname)
+		logging.debug("Loaded %d records from hash cache %s", len(self.records), pathname)
+
+	def key(self, e):
+		"Returns the pathname and the stat fields identifying a file, or None"
+		if not isinstance(e, DirEntry) or type(e.SrcPathname) not in (type(''), type(u'')):
+			return None
+		return unicode(os.path.abspath(e.SrcPathname)), e.stamp
+
+	def get(self, e):
+		"Returns the recorded SHA-1 of a file, if it still holds"
+		k = self.key(e)
+		if not k: return None
+		r = self.records.get(k[0])
+		if r and r[:4] == k[1]:
+			self.hits += 1
+			self.used.add(k[0])
+			return r[4]
+		self.misses += 1
+		return None
+
+	def put(self, e, crc):
+		"Records the SHA-1 of a file"
+		k = self.key(e)
+		if not k or max(k[1][1], k[1][2]) > self.started - self.RACY: return # mtime or ctime too recent
+		self.records[k[0]] = k[1] + (crc, 0)
+		self.used.add(k[0])
+
+	def save(self):
+		"Writes the records back, aging the unused ones"
+		out = []
+		for pathname, r in self.records.iteritems():
+			age = (r[5]+1, 0)[pathname in self.used]
+			if age > self.MAX_AGE: continue
+			pathname = pathname.encode('utf8')
+			out += [self.RECORD.pack(*(r[:5] + (age, len(pathname)))), pathname]
+		tmp = self.pathname + '.tmp'
+		fp = open(tmp, 'wb')
+		fp.write(self.MAGIC)
+		fp.write(''.join(out))
+		fp.close()
+		# The new file replaces the old one at once, so a crash leaves either of them
+		if sys.platform == 'win32' and os.path.exists(self.pathname): # rename can't overwrite
+			if windll.kernel32.MoveFileExW(unicode(tmp), unicode(self.pathname), 1): # MOVEFILE_REPLACE_EXISTING
+				return
+			os.remove(self.pathname)
+		os.rename(tmp, self.pathname)
+		logging.debug("Hash cache %s: %d hits, %d misses, %d records saved", self.pathname, self.hits, self.misses, len(out)/2)
+
+
+def plan_dedup(resources, refcounts, min_size, hashes):
+	"""Finds in advance the SHA-1 of the resources which may be duplicates, reading only those
+	sharing their size with another resource: first their initial chunk, then, if it matches too,
+	their whole content. Adds the fully hashed ones to hashes, {id(resource): sha-1}"""
+	by_size = {}
+	for e in resources:
+		if e.FileSize > min_size:
+			by_size.setdefault(e.FileSize, []).append(e)
+	stored = set([h[1] for h in refcounts.values()]) # sizes of the resources already in the image
+	known = len(hashes)
+	for size, group in by_size.iteritems():
+		todo = [e for e in group if id(e) not in hashes]
+		if not todo or (len(group) < 2 and size not in stored): continue # unique size
+		if len(todo) < len(group): # a first chunk can't be compared with a known hash
+			candidates = [todo]
+		else:
+			by_chunk = {}
+			for e in todo:
+				try:
+					fp, chunk_crc = take_sha(e.SrcPathname, first_chunk=1)
+				except:
+					continue # reported when packing
+				if fp is not e.SrcPathname: fp.close()
+				by_chunk.setdefault(chunk_crc, []).append(e)
+			candidates = [peers for peers in by_chunk.values() if len(peers) > 1 or size in stored]
+		for peers in candidates:
+			for e in peers:
+				try:
+					fp, hashes[id(e)] = take_sha(e.SrcPathname)
+				except:
+					continue
+				if fp is not e.SrcPathname: fp.close()
+	logging.debug("Dedup planner: %d of %d large resources fully hashed in advance", len(hashes) - known, sum(map(len, by_size.values())))
+	return hashes
+
+def make_fileresources(out, comp, entries, refcounts, total_input_bytes, start_time, codec, hash_cache=None, hashes=None):
+	"""Packs the files content into the image, discarding duplicates according to their SHA-1.
+	hashes, {id(resource): sha-1}, may give in advance the SHA-1 of some resources"""
 	totalBytes = 0 # Total bytes for files uncompressed content, duplicates included
 
 	comp_start_time = time.time()
 	
-	chunk_hash_table = {}
-	
+	small = SmallResources(out, refcounts, codec)
+
+	# Collects the resources to pack: files, reparse points and, last, the ADSs
+	resources, streams = [], []
 	for e in entries:
 		# Skips folders, NULL entries and empty files. Reparse points are handled like files.
 		if isinstance(e, DirEntry):
 			if e.wStreams: # has ADSs
 				for ads in e.alt_data_streams:
 					if ads.FileSize:
-						entries.append(ads)
+						streams.append(ads)
 			if (e.dwAttributes & 0x10 and not e.dwAttributes & 0x400) or not e.liLength or not e.FileSize: continue
 			# Handles a special case: reparse points
 			if e.dwAttributes & 0x400:
 				e.SrcPathname = StringIO(e.sReparseData)
 				e.bCompressed = 0
 				e.liSubdirOffset = 0
+		resources.append(e)
+	resources += streams
+
+	hashes = dict(hashes or {}) # {id(resource): sha-1} known before reading the resource
+	if hash_cache:
+		for e in resources:
+			crc = id(e) not in hashes and hash_cache.get(e)
+			if crc:
+				hashes[id(e)] = crc
+	# Only the resources of the same size can be duplicates
+	plan_dedup(resources, refcounts, codec.chunk_size, hashes)
+	
+	for e in resources:
 		e.bCompressed = comp
-		try:
-			fp, chunk_crc = take_sha(e.SrcPathname, first_chunk=1)
-		except:
-			logging.debug("Could not capture '%s', skipped.", e.SrcPathname)
-			print "WARNING: could not capture '%s', skipped." % e.SrcPathname
-			totalBytes += e.FileSize
-			print_progress(comp_start_time, totalBytes, total_input_bytes)
-			continue
-		if chunk_crc in chunk_hash_table:
-			fp, crc = take_sha(e.SrcPathname)
+		crc = hashes.get(id(e))
+		# Single chunk resources are hashed in memory and compressed in batches
+		if e.FileSize <= codec.chunk_size:
+			if crc not in refcounts:
+				try:
+					s = read_resource(e.SrcPathname, e.FileSize)
+				except:
+					logging.debug("Could not capture '%s', skipped.", e.SrcPathname)
+					print "WARNING: could not capture '%s', skipped." % e.SrcPathname
+					totalBytes += e.FileSize
+					continue
+				if not crc:
+					crc = hashlib.sha1(s).digest()
+					if hash_cache: hash_cache.put(e, crc)
 			if crc in refcounts:
 				h = refcounts[crc]
 				refcounts[crc] = (h[0], h[1], h[2], h[3]+1, h[4])
 				logging.debug("Discarded %s (hash collision)", e.SrcPathname)
 				e.Offset = h[0]
 				e.bHash = crc
-				totalBytes += e.FileSize
-				print_progress(comp_start_time, totalBytes, total_input_bytes)
-				continue
-			calc_crc = False
-		else:
-			chunk_hash_table[chunk_crc] = 1
-			calc_crc = True
+			else:
+				small.add(e, s, crc)
+			totalBytes += e.FileSize
+			print_progress(comp_start_time, totalBytes, total_input_bytes)
+			continue
+		small.flush() # keeps resources in the capture order
+		if hash_cache and crc:
+			hash_cache.put(e, crc)
+		if crc in refcounts: # a duplicate found by the planner, not read again
+			h = refcounts[crc]
+			refcounts[crc] = (h[0], h[1], h[2], h[3]+1, h[4])
+			logging.debug("Discarded %s (hash collision)", e.SrcPathname)
+			e.Offset = h[0]
+			e.bHash = crc
+			totalBytes += e.FileSize
+			print_progress(comp_start_time, totalBytes, total_input_bytes)
+			continue
+		calc_crc = crc is None # the planner did not hash a resource with unique size
 		if isinstance(e, DirEntry) and e.dwAttributes & 0x400:
 			e.SrcPathname = StringIO(e.sReparseData)
+		try:
+			if type(e.SrcPathname) in (type(''), type(u'')):
+				fp = open(e.SrcPathname, 'rb')
+			else:
+				fp = e.SrcPathname
+		except:
+			logging.debug("Could not capture '%s', skipped.", e.SrcPathname)
+			print "WARNING: could not capture '%s', skipped." % e.SrcPathname
+			totalBytes += e.FileSize
+			print_progress(comp_start_time, totalBytes, total_input_bytes)
+			continue
 		e.Offset = out.tell() # Fileresource start offset inside WIM
 		logging.debug("Starting new File resource @%08X", e.Offset)
 		#~ logging.debug("fp=%s, out=%s, e.FileSize=%d, calc_crc=%s", fp, out, e.FileSize, calc_crc)
-		Codecs.Codec.compress(fp, out, e.FileSize, calc_crc)
+		codec.compress(fp, out, e.FileSize, calc_crc)
 		if calc_crc:
-			crc = Codecs.Codec.sha1.digest()
-			if crc in refcounts: # This is required for proper append task!
+			crc = codec.sha1.digest()
+			if hash_cache: hash_cache.put(e, crc)
+			if crc in refcounts: # the planner could not read the file, or it changed since
 				h = refcounts[crc]
 				refcounts[crc] = (h[0], h[1], h[2], h[3]+1, h[4])
 				logging.debug("Discarded %s (hash collision) - stream rewinded", e.SrcPathname)
@@ -253,19 +585,28 @@ def make_fileresources(out, comp, entries, refcounts, total_input_bytes, start_t
 				e.bHash = crc
 				totalBytes += e.FileSize
 				print_progress(comp_start_time, totalBytes, total_input_bytes)
+				fp.close()
 				continue
 		logging.debug("Wrote content from %s", e.SrcPathname)
-		e.cFileSize = Codecs.Codec.osize
+		e.cFileSize = codec.osize
 		e.bHash = crc
 		refcounts[e.bHash] = (e.Offset, e.FileSize, e.cFileSize, 1, e.bCompressed)
 		totalBytes += e.FileSize
 		print_progress(comp_start_time, totalBytes, total_input_bytes)
 		fp.close() # check for ADS!!!
+	small.flush()
+	if hash_cache:
+		hash_cache.save()
 	return totalBytes, refcounts
 	
+def get_hash_cache(opts):
+	"Opens the persistent file hash cache, if one was requested"
+	if getattr(opts, 'hash_cache', None):
+		return HashCache(opts.hash_cache)
+
 def make_offsettable(hash, e, partnum=1):
-	o = OffsetTableEntry(64*'\0')
-	o.rhOffsetEntry = DiskResHdr(64*'\0')
+	o = OffsetTableEntry()
+	o.rhOffsetEntry = DiskResHdr()
 	o.rhOffsetEntry.liOffset = e[0]
 	o.rhOffsetEntry.liOriginalSize = e[1]
 	o.rhOffsetEntry.ullSize = e[2]
@@ -278,18 +619,18 @@ def make_offsettable(hash, e, partnum=1):
 	return o
 
 def make_offsetimage(codec, offset):
-	o = OffsetTableEntry(64*'\0')
-	o.rhOffsetEntry = DiskResHdr(64*'\0')
+	o = OffsetTableEntry()
+	o.rhOffsetEntry = DiskResHdr()
 	o.rhOffsetEntry.ullSize = codec.osize
 	o.rhOffsetEntry.bFlags = 2 # Flag as Metadata
 	o.rhOffsetEntry.liOffset = offset
-	o.rhOffsetEntry.liOriginalSize = Codecs.Codec.isize
+	o.rhOffsetEntry.liOriginalSize = codec.isize
 	if o.rhOffsetEntry.ullSize < o.rhOffsetEntry.liOriginalSize:
 		o.rhOffsetEntry.bFlags |= 4 # mark as compressed
 	logging.debug("Metadata resource @%0X for %d bytes (%d original)",o.rhOffsetEntry.liOffset, o.rhOffsetEntry.ullSize, o.rhOffsetEntry.liOriginalSize)
 	o.usPartNumber = 1
 	o.dwRefCount = 1
-	o.bHash = Codecs.Codec.sha1.digest()
+	o.bHash = codec.sha1.digest()
 	return o
 	
 def make_xmldata(wimTotBytes, dirCount, fileCount, totalBytes, hardlinkBytes, StartTime, StopTime, index=1, imgname='', xml=None, imgdsc=''):
@@ -414,22 +755,20 @@ def finalize_wimheader(wim, fp):
 def create(opts, args):
 	# Note: writing to a new file is twice as faster than writing to a preexisting one!
 	# It seems necessary to erase the previous file, or it becomes very slow on writing!
-	if os.path.exists(args[1]):
-		os.remove(args[1])
-	out = open(args[1], 'wb')
-
 	COMPRESSION_TYPE = {'none':0, 'xpress':1, 'lzx':2}[opts.compression_type.lower()]
 	srcdir = args[0]
 
-	Codecs.Codec = Codecs.CodecMT(opts.num_threads, COMPRESSION_TYPE)
-	
-	if opts.threshold:
-		Codecs.Codec.threshold_size = opts.threshold.size
-		Codecs.Codec.threshold_ratio = opts.threshold.ratio
-		Codecs.Codec.threshold_ratio = opts.threshold.ratio
+	# Gets the codec first, so an unsupported chunk size stops before touching the WIM
+	CHUNK_SIZE = getattr(opts, 'chunk_size', 0x8000)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, CHUNK_SIZE)
+	codec.probe = opts.probe
+
+	if os.path.exists(args[1]):
+		os.remove(args[1])
+	out = open(args[1], 'wb')
 	
 	# 1 - WIM Header
-	wim = make_wimheader(COMPRESSION_TYPE)
+	wim = make_wimheader(COMPRESSION_TYPE, CHUNK_SIZE)
 	out.write(wim.tostr())
 
 	AcquirePrivilege("SeBackupPrivilege")
@@ -441,12 +780,12 @@ def create(opts, args):
 
 	# Collects input files
 	print "Collecting files..."
-	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list)
+	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list, opts.scan_threads)
 	
 	# 2 - File contents
 	print "Packing contents..."
 	RefCounts = OrderedDict() # {sha-1: (offset, size, csize, count, flags)}
-	imgTotalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime)
+	imgTotalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime, codec, get_hash_cache(opts))
 	
 	sd_raw = security.tostr()
 
@@ -466,7 +805,7 @@ def create(opts, args):
 
 	meta_size = meta.tell() # uncomp/comp size
 	meta.seek(0)
-	Codecs.Codec.compress(meta, out, meta_size, True)
+	codec.compress(meta, out, meta_size, True)
 	
 	StopTime = time.time()
 
@@ -474,7 +813,7 @@ def create(opts, args):
 	print "Building the Offsets table..."
 	wim.rhOffsetTable.liOffset = out.tell()
 	logging.debug("Writing Offset table @0x%08X", wim.rhOffsetTable.liOffset)
-	oimg = make_offsetimage(Codecs.Codec, image_start)
+	oimg = make_offsetimage(codec, image_start)
 	out.write(oimg.tostr())
 	for e in RefCounts:
 		out.write(make_offsettable(e, RefCounts[e]).tostr())
@@ -492,4 +831,6 @@ def create(opts, args):
 		
 	finalize_wimheader(wim, out)
 
+	print_probe(codec)
+	print_memo(codec)
 	print_timings(StartTime, StopTime)
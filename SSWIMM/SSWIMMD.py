@@ -13,6 +13,7 @@ import w32_fnmatch
 fnmatch.translate = w32_fnmatch.win32_translate
 import hashlib
 import logging
+import mmap
 import optparse
 import os
 import shutil
@@ -25,7 +26,10 @@ from collections import OrderedDict
 from datetime import datetime as dt
 from xml.etree import ElementTree as ET
 from WIMArchive import *
-from Codecs import CodecMT
+import Codecs
+
+DWORD = struct.Struct('<I')
+QWORD = struct.Struct('<Q')
 
 
 def get_wimheader(fp):
@@ -60,32 +64,46 @@ def get_xmldata(fp, wim):
 	fp.seek(pos)
 	return s
 	
-def get_offsettable(fp, wim):
-	"Build a dictionary from the offset table entries, ordered by hash"
+def parse_offsettable(fp, wim):
+	"""Reads the offset table at once and decodes it in one pass, returning it as an OffsetTable
+	and the list of the image resources"""
 	fp.seek(wim.rhOffsetTable.liOffset)
-	otab = OrderedDict()
-	while fp.tell() < wim.rhOffsetTable.liOffset + wim.rhOffsetTable.liOriginalSize:
-		ote = OffsetTableEntry(fp.read(50))
-		otab[ote.bHash] = ote
-	return otab
-
-def get_images(fp, wim):
-	"Retrieve the image resources from the offset table entries"
+	s = fp.read(wim.rhOffsetTable.liOriginalSize)
+	otab = OffsetTable(s)
 	# Image resources have to be ordered by offset in the Offset table
 	images = [] # an image entry MAY be repeated if metadatas are equal!
-	fp.seek(wim.rhOffsetTable.liOffset)
-	while fp.tell() < wim.rhOffsetTable.liOffset + wim.rhOffsetTable.liOriginalSize:
-		ote = OffsetTableEntry(fp.read(50))
-		if ote.rhOffsetEntry.bFlags & 2: # Image resource
+	n = OffsetTableEntry.size
+	for i in xrange(0, len(s) - n + 1, n):
+		if ord(s[i+7]) & 2: # Image resource (flags are the high byte of ullSize)
+			ote = OffsetTableEntry(s, i)
 			logging.debug("Image Metadata resource found @%08X", ote.rhOffsetEntry.liOffset)
 			images += [ote]
+	return otab, images
+
+def load_offsettable(fp, wim):
+	"Returns both the offset table dictionary and the image resources, reading the table once"
+	otab, images = parse_offsettable(fp, wim)
 	if not images:
 		logging.debug("FATAL: no image found!")
 		raise BadWim
-	return images
+	return otab, images
+
+def get_offsettable(fp, wim):
+	"Build the offset table, indexed by hash"
+	return parse_offsettable(fp, wim)[0]
+
+def get_images(fp, wim):
+	"Retrieve the image resources from the offset table entries"
+	return load_offsettable(fp, wim)[1]
 
-def get_resource(fpi, ote, null=False, target=None):
-	"Test a resource and returns a stream to it, eventually expanded"
+def resource_key(ote, guid):
+	"Identifies a resource in the chunk cache, if the WIM GUID is given"
+	if guid:
+		return guid, ote.usPartNumber, ote.rhOffsetEntry.liOffset
+
+def get_resource(fpi, ote, codec, null=False, target=None, guid=None):
+	"""Test a resource and returns a stream to it, eventually expanded. The WIM GUID, if given,
+	caches the chunks: pass it only for resources read again, like the Metadata"""
 	pos = fpi.tell()
 	fpi.seek(ote.rhOffsetEntry.liOffset)
 	if null:
@@ -95,10 +113,18 @@ def get_resource(fpi, ote, null=False, target=None):
 			tmpres = open(target, 'wb')
 		else:
 			tmpres = tempfile.TemporaryFile()
-	Codecs.Codec.decompress(fpi, ote.rhOffsetEntry.ullSize, tmpres, ote.rhOffsetEntry.liOriginalSize, True)
+	codec.decompress(fpi, ote.rhOffsetEntry.ullSize, tmpres, ote.rhOffsetEntry.liOriginalSize, True, resource_key(ote, guid))
 	fpi.seek(pos)
 	tmpres.seek(0)
-	return (ote.bHash == Codecs.Codec.sha1.digest(), tmpres)
+	return (ote.bHash == codec.sha1.digest(), tmpres)
+
+def get_resource_range(fpi, ote, offset, size, codec, guid=None):
+	"Returns a byte range from a resource, decompressing only the chunks it spans"
+	pos = fpi.tell()
+	fpi.seek(ote.rhOffsetEntry.liOffset)
+	s = codec.read_range(fpi, ote.rhOffsetEntry.ullSize, ote.rhOffsetEntry.liOriginalSize, offset, size, resource_key(ote, guid))
+	fpi.seek(pos)
+	return s
 
 def get_securitydata(fp):
 	"Build the SecurityData hash table"
@@ -119,61 +145,80 @@ def get_securitydata(fp):
 			logging.debug("Invalid SD found at index #%d", len(sd.SDS)-1)
 	return sd
 	
+def map_metadata(fp):
+	"Returns the whole uncompressed Metadata as a buffer: a read only map of its file, or its contents"
+	try:
+		fileno = fp.fileno()
+	except (AttributeError, IOError, ValueError): # an in-memory stream
+		fileno = -1
+	fp.seek(0, 2)
+	if fileno > -1 and fp.tell():
+		fp.flush()
+		return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+	fp.seek(0)
+	return fp.read()
+
 def get_direntries(fp):
 	"Build the DIRENTRY table and reconstructs the original tree"
-	fp.seek(0)
-	sd_size = struct.unpack('<I', fp.read(4))[0]
-	sd_size += 8 - (sd_size%8) & 7 # it's QWORD aligned!
-	fp.seek(sd_size)
+	s = map_metadata(fp)
+	try:
+		return parse_direntries(s)
+	finally:
+		if isinstance(s, mmap.mmap): s.close()
+
+def parse_direntries(s):
+	"""Decodes the DIRENTRYs and STREAMENTRYs in place from a buffer with the whole Metadata,
+	grouping them by hash in lists"""
+	debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+	unpack_size = QWORD.unpack_from
+	pos = DWORD.unpack_from(s)[0]
+	pos += 8 - (pos%8) & 7 # it's QWORD aligned!
 	direntries = OrderedDict()
 	directories = OrderedDict()
 	parent = -1 # parent's offset == key in directories dict
-	while 1:
-		pos = fp.tell()
+	while pos + 8 <= len(s):
 		if pos in directories: parent = pos
-		s = fp.read(8)
-		if not s: break
-		size = struct.unpack('<Q', s)[0] & 0x00FFFFFFFFFFFFFF
-		if size:
-			fp.seek(-8, 1)
-			d = DirEntry(fp.read(size))
-			d._pos = pos
-			d._parent = parent
-			d.alt_data_streams = [] # collects the ADS
-			if d.bHash in direntries:
-				direntries[d.bHash] += (d,)
-			else:
-				direntries[d.bHash] = (d,)
-			logging.debug("Parsed DIRENTRY @0x%08X:\n%s", pos, d)
-			# Parses the alternate data streams if present
-			for i in range(d.wStreams):
-				size = struct.unpack('<Q', fp.read(8))[0] & 0x00FFFFFFFFFFFFFF
-				fp.seek(-8, 1)
-				pos = fp.tell()
-				se = StreamEntry(fp.read(size))
-				se.parent = d # Parent DIRENTRY: hack for symlinks
-				if se.FileName:
-					se.FileName = d.FileName + ':' + se.FileName
-				else: # the unnamed stream is the main one!
-					se.FileName = d.FileName
-				se._parent = parent
-				d.alt_data_streams += [se]
-				if se.bHash in direntries:
-					direntries[se.bHash] += (se,)
-				else:
-					direntries[se.bHash] = (se,)
-				logging.debug("Parsed STREAMENTRY @0x%08X:\n%s", pos, se)
-			# A symlink to a directory isn't a real directory; a junction is
-			if d.dwAttributes & 0x10 and d.dwReparseReserved != 0xA000000C:
-				if d.FileName == '':
-					fname = os.sep
-				else:
-					fname = d.FileName
-				fname = os.path.join(directories.get(parent,''), fname)
-				directories[d.liSubdirOffset] = fname
-				logging.debug("Directory '%s' @0x%08x, contents @0x%08x", fname, d._pos, d.liSubdirOffset)
+		size = unpack_size(s, pos)[0] & 0x00FFFFFFFFFFFFFF
+		if not size:
+			if debug: logging.debug("Parsed End of Directory NULL marker")
+			pos += 8
+			continue
+		d = DirEntry(s, pos)
+		d._pos = pos
+		d._parent = parent
+		d.alt_data_streams = [] # collects the ADS
+		if d.bHash in direntries:
+			direntries[d.bHash].append(d)
 		else:
-			logging.debug("Parsed End of Directory NULL marker")
+			direntries[d.bHash] = [d]
+		if debug: logging.debug("Parsed DIRENTRY @0x%08X:\n%s", pos, d)
+		pos += size
+		# Parses the alternate data streams if present
+		for i in xrange(d.wStreams):
+			size = unpack_size(s, pos)[0] & 0x00FFFFFFFFFFFFFF
+			se = StreamEntry(s, pos)
+			se.parent = d # Parent DIRENTRY: hack for symlinks
+			if se.FileName:
+				se.FileName = d.FileName + ':' + se.FileName
+			else: # the unnamed stream is the main one!
+				se.FileName = d.FileName
+			se._parent = parent
+			d.alt_data_streams += [se]
+			if se.bHash in direntries:
+				direntries[se.bHash].append(se)
+			else:
+				direntries[se.bHash] = [se]
+			if debug: logging.debug("Parsed STREAMENTRY @0x%08X:\n%s", pos, se)
+			pos += size
+		# A symlink to a directory isn't a real directory; a junction is
+		if d.dwAttributes & 0x10 and d.dwReparseReserved != 0xA000000C:
+			if d.FileName == '':
+				fname = os.sep
+			else:
+				fname = d.FileName
+			fname = os.path.join(directories.get(parent,''), fname)
+			directories[d.liSubdirOffset] = fname
+			if debug: logging.debug("Directory '%s' @0x%08x, contents @0x%08x", fname, d._pos, d.liSubdirOffset)
 	return direntries, directories
 
 def get_xmldata_root(wim, fp):
@@ -198,8 +243,11 @@ def get_xmldata_imgindex(xmlobj, name):
 def get_xmldata_imgctime(xmlobj, index):
 	for node in xmlobj.iter('IMAGE'):
 		if node.get('INDEX') == str(index):
-			c_time = int(node.find('CREATIONTIME/HIGHPART').text, 16)
-			c_time = (c_time << 32) | int(node.find('CREATIONTIME/LOWPART').text, 16)
+			high, low = node.find('CREATIONTIME/HIGHPART'), node.find('CREATIONTIME/LOWPART')
+			if high is None or low is None: # not recorded
+				return None
+			c_time = int(high.text, 16)
+			c_time = (c_time << 32) | int(low.text, 16)
 			return nt2uxtime(c_time)
 
 def get_xmldata_imgmtime(xmlobj, index):
@@ -226,9 +274,9 @@ def get_image_from_id(wim, fp, id):
 			sys.exit(1)
 	return img_index
 
-def get_metadata(fpi, image):
+def get_metadata(fpi, image, codec, guid=None):
 	"Returns a stream to the uncompressed Metadata resource"
-	is_good, metadata = get_resource(fpi, image)
+	is_good, metadata = get_resource(fpi, image, codec, guid=guid)
 	if not is_good:
 		logging.debug("FATAL: broken Metadata resource!")
 		sys.exit(1)
@@ -247,17 +295,15 @@ def test(opts, args):
 
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
 
-	offset_table = get_offsettable(fpi, wim)
+	offset_table, images = load_offsettable(fpi, wim)
 
 	if len(args) > 1:
 		img_index = get_image_from_id(wim, fpi, args[1])
 	else:
 		img_index = 0
 
-	images = get_images(fpi, wim)
-
 	if img_index > len(images):
 		print "Image index doesn't exist!"
 		sys.exit(1)
@@ -280,7 +326,7 @@ def test(opts, args):
 			print "Integrity check passed!"
 
 		print "Opening Metadata resource..."
-		metadata = get_metadata(fpi, image)
+		metadata = get_metadata(fpi, image, codec, wim.gWIMGuid)
 
 		security = get_securitydata(metadata)
 
@@ -295,7 +341,7 @@ def test(opts, args):
 		# Simply pick the TOTALBYTES field from XML?
 		for ote in direntries:
 			if ote == NULLK: continue # skips NULL keys
-			totalOutputBytes += offset_table[ote].rhOffsetEntry.liOriginalSize * len(direntries[ote])
+			totalOutputBytes += offset_table.field(ote, 'liOriginalSize') * len(direntries[ote])
 
 		application_start_time = time.time()
 
@@ -307,7 +353,7 @@ def test(opts, args):
 			fres = direntries[ote][0]
 			fname = os.path.join(directories[fres._parent][1:], fres.FileName)
 
-			is_good, file_res = get_resource(fpi, offset_table[ote], 1, fname)
+			is_good, file_res = get_resource(fpi, offset_table[ote], codec, 1, fname)
 			logging.debug("File resource '%s' expanded", fres.FileName)
 
 			if not is_good:
@@ -315,7 +361,7 @@ def test(opts, args):
 				print "File '%s' corrupted!" % fname
 				logging.debug("CRC error for %s", fname)
 
-			totalBytes += offset_table[ote].rhOffsetEntry.liOriginalSize
+			totalBytes += offset_table.field(ote, 'liOriginalSize')
 			print_progress(application_start_time, totalBytes, totalOutputBytes)			
 
 		if badfiles:
@@ -325,14 +371,12 @@ def test(opts, args):
 
 	StopTime = time.time()
 
+	print_cache(codec)
 	print_timings(StartTime, StopTime)
 
 
 def extract(opts, args):
-	def is_excluded(s, excludes):
-		i_pname = s[s.find('\\'):] # pathname how it will be inside the image
-		# if the excluded item is a dir, we want subcontents excluded also! (x+\*)
-		return True in map(lambda x:fnmatch.fnmatch(i_pname, x) or fnmatch.fnmatch(i_pname, x+'\\*'), excludes)
+	is_excluded = make_exclusion_matcher(opts.exclude_list)
 
 	StartTime = time.time()
 
@@ -343,17 +387,15 @@ def extract(opts, args):
 
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
 
-	offset_table = get_offsettable(fpi, wim)
+	offset_table, images = load_offsettable(fpi, wim)
 
 	if len(args) > 1:
 		img_index = get_image_from_id(wim, fpi, args[1])
 	else:
 		img_index = 0
 
-	images = get_images(fpi, wim)
-
 	if img_index > len(images):
 		print "Image index doesn't exist!"
 		sys.exit(1)
@@ -387,7 +429,7 @@ def extract(opts, args):
 			print "Integrity check passed!"
 
 		print "Opening Metadata resource..."
-		metadata = get_metadata(fpi, image)
+		metadata = get_metadata(fpi, image, codec, wim.gWIMGuid)
 
 		security = get_securitydata(metadata)
 
@@ -402,13 +444,10 @@ def extract(opts, args):
 		# Simply pick the TOTALBYTES field from XML?
 		for ote in direntries:
 			if ote == NULLK: continue # skips NULL keys
-			totalOutputBytes += offset_table[ote].rhOffsetEntry.liOriginalSize * len(direntries[ote])
+			totalOutputBytes += offset_table.field(ote, 'liOriginalSize') * len(direntries[ote])
 
-		# Sorts by on-disk resource offset
-		def direntries_sort(a, b):
-			if a[0] == NULLK or b[0] == NULLK: return 0
-			return cmp(offset_table[a[0]].rhOffsetEntry.liOffset, offset_table[b[0]].rhOffsetEntry.liOffset)
-		direntries = OrderedDict(sorted(direntries.items(), direntries_sort))
+		# Sorts by on-disk resource offset (NULL key first)
+		direntries = OrderedDict(sorted(direntries.items(), key=lambda x: offset_table.rank(x[0])))
 		
 		application_start_time = time.time()
 		
@@ -416,7 +455,7 @@ def extract(opts, args):
 		for fres in direntries[NULLK]:
 			if not hasattr(fres, 'dwAttributes'): continue # skips STREAMs
 			fname = os.path.join(args[2], directories.get(fres._parent, "")[1:], fres.FileName)
-			if opts.exclude_list and is_excluded(fname, opts.exclude_list):
+			if is_excluded(fname):
 				continue
 			if fres.dwAttributes & 0x10: # creates the empty directory
 				if os.path.exists(fname):
@@ -440,8 +479,8 @@ def extract(opts, args):
 				# target pathname
 				fname = os.path.join(args[2], directories[fres._parent][1:], fres.FileName)
 
-				if opts.exclude_list and is_excluded(fname, opts.exclude_list):
-					totalBytes += offset_table[ote].rhOffsetEntry.liOriginalSize
+				if is_excluded(fname):
+					totalBytes += offset_table.field(ote, 'liOriginalSize')
 					continue
 
 				# Expands the resource the first time, then duplicates or hardlinks it
@@ -457,7 +496,7 @@ def extract(opts, args):
 						shutil.copy(first_fname, fname)
 						logging.debug("Duplicate File resource: copied '%s' to '%s'", first_fname, fname)
 				else:
-					is_good, file_res = get_resource(fpi, offset_table[ote], 0, fname)
+					is_good, file_res = get_resource(fpi, offset_table[ote], codec, 0, fname)
 					logging.debug("File resource '%s' expanded", fres.FileName)
 
 					if not is_good:
@@ -511,7 +550,7 @@ def extract(opts, args):
 								else:
 									logging.debug("Creating hard link %s => %s", fname, sn)
 									os.link(sn, fname)
-				totalBytes += offset_table[ote].rhOffsetEntry.liOriginalSize
+				totalBytes += offset_table.field(ote, 'liOriginalSize')
 				print_progress(application_start_time, totalBytes, totalOutputBytes)			
 
 				total_restored_files += 1
@@ -523,7 +562,7 @@ def extract(opts, args):
 		for ote in reversed(direntries): # touch DIRs last
 			for fres in direntries[ote]:
 				fname = os.path.join(args[2], directories.get(fres._parent, '')[1:], fres.FileName)
-				if opts.exclude_list and is_excluded(fname, opts.exclude_list):
+				if is_excluded(fname):
 					continue
 				if not os.path.exists(fname):
 					continue
@@ -553,4 +592,5 @@ def extract(opts, args):
 
 	StopTime = time.time()
 
+	print_cache(codec)
 	print_timings(StartTime, StopTime)
@@ -24,9 +24,9 @@ def list(opts, args):
 
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
 
-	offset_table = get_offsettable(fpi, wim)
+	offset_table, images = load_offsettable(fpi, wim)
 
 	if len(args) < 2:
 		args += ['1'] # set default argument: first image
@@ -41,7 +41,6 @@ def list(opts, args):
 			print "Image %s doesn't exist!" % args[1]
 			sys.exit(1)
 
-	images = get_images(fpi, wim)
 	if img_index > len(images):
 		print "There is no such Image in WIM!"
 		sys.exit(1)
@@ -49,7 +48,7 @@ def list(opts, args):
 	image = images[img_index]
 	
 	print "Opening Metadata resource..."
-	metadata = get_metadata(fpi, image)
+	metadata = get_metadata(fpi, image, codec, wim.gWIMGuid)
 
 	direntries, directories = get_direntries(metadata)
 	
@@ -89,17 +89,14 @@ def split(opts, args):
 
 	wim.dwFlags |= 0x8 # FLAG_HEADER_SPANNED
 
-	offset_table = get_offsettable(out, wim)
-	images = get_images(out, wim)
+	offset_table, images = load_offsettable(out, wim)
 	xmldata = get_xmldata(out, wim)
 	
 	# sizeof(WIMHEADER) + sizeof(XMLDATA) + sizeof(1 offset table entry)
 	min_swm_unit_expansion = 208 + (len(xmldata)+1)*2 + 50
 	
-	for o in offset_table.values():
-		if o.rhOffsetEntry.bFlags & 2: # skips image resource
-			continue
-		RefCounts[o.bHash] = [o.rhOffsetEntry.liOffset, o.rhOffsetEntry.liOriginalSize, o.rhOffsetEntry.ullSize, o.dwRefCount, o.rhOffsetEntry.bFlags]
+	for r in offset_table.iterresources(): # skips image resources
+		RefCounts[r[0]] = list(r[1:]) # offset, size, compressed size, count, flags
 	
 	# sorted by size
 	items = sorted(RefCounts, lambda a, b:cmp(RefCounts[b][2], RefCounts[a][2]))
@@ -23,6 +23,40 @@ from WIMArchive import *
 from SSWIMMC import *
 from SSWIMMD import *
 
+def image_pathname(pathname, srcdir):
+	"Returns a captured pathname relative to the source folder, as stored inside the image"
+	if pathname.startswith('\\\\?\\'):
+		pathname = pathname[4:]
+	return os.path.relpath(os.path.abspath(pathname), os.path.abspath(srcdir))
+
+def get_unchanged(entries, srcdir, direntries, directories, refcounts, since):
+	"""Returns {id(resource): sha-1} for the files (and their ADSs) found in the old image
+	with the same pathname, size, last write time and attributes, whose content needs not
+	to be read again. Files written after since (NT time) may have changed unnoticed"""
+	old = {} # {pathname inside the image: DIRENTRY or STREAMENTRY}
+	for t in direntries.itervalues():
+		for d in t:
+			if isinstance(d, DirEntry):
+				if d.dwAttributes & 0x10: continue
+				old[os.path.join(directories[d._parent][1:], d.FileName)] = d
+			elif d.StreamName: # the unnamed stream is the file itself
+				old[os.path.join(directories[d._parent][1:], d.FileName)] = d
+	hashes = {}
+	for e in entries:
+		if not isinstance(e, DirEntry) or not e.liLength or e.dwAttributes & 0x410: continue
+		d = old.get(image_pathname(e.SrcPathname, srcdir))
+		if d is None or d.dwAttributes != e.dwAttributes or d.liLastWriteTime != e.liLastWriteTime or d.liLastWriteTime >= since:
+			continue
+		pairs = [(e, d)]
+		for ads in e.alt_data_streams:
+			if type(ads.SrcPathname) in (type(''), type(u'')): # streams made in memory are cheap
+				pairs += [(ads, old.get(image_pathname(ads.SrcPathname, srcdir)))]
+		for r, o in pairs:
+			if o is not None and o.bHash in refcounts and refcounts[o.bHash][1] == r.FileSize:
+				hashes[id(r)] = o.bHash
+	logging.debug("%d resources unchanged since the last update", len(hashes))
+	return hashes
+
 def update(opts, args):
 	srcdir = args[0]
 	if not os.path.exists(srcdir):
@@ -45,10 +79,10 @@ def update(opts, args):
 		
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
+	codec.probe = opts.probe
 
-	offset_table = get_offsettable(out, wim)
-	images = get_images(out, wim)
+	offset_table, images = load_offsettable(out, wim)
 
 	image_index_to_update = get_image_from_id(wim, out, args[2])
 
@@ -59,13 +93,11 @@ def update(opts, args):
 	print "Opening WIM for update, image #%d..." % image_index_to_update
 	image_index_to_update -= 1
 	
-	for o in offset_table.values():
-		if o.rhOffsetEntry.bFlags & 2: # skips image resource
-			continue
-		RefCounts[o.bHash] = [o.rhOffsetEntry.liOffset, o.rhOffsetEntry.liOriginalSize, o.rhOffsetEntry.ullSize, o.dwRefCount, o.rhOffsetEntry.bFlags]
+	for r in offset_table.iterresources(): # skips image resources
+		RefCounts[r[0]] = list(r[1:]) # offset, size, compressed size, count, flags
 
-		print "Opening Metadata resource..."
-		metadata = get_metadata(out, images[image_index_to_update])
+	print "Opening Metadata resource..."
+	metadata = get_metadata(out, images[image_index_to_update], codec)
 
 	direntries, directories = get_direntries(metadata)
 
@@ -77,7 +109,15 @@ def update(opts, args):
 
 	# Collects input files
 	print "Collecting new files..."
-	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list)
+	direntries_size, entries, subdirs, total_input_bytes = make_direntries(srcdir, security, opts.exclude_list, opts.scan_threads)
+
+	hashes = None
+	if opts.incremental:
+		# Files written while the old image was captured could have changed after being read
+		ctime = get_xmldata_imgctime(get_xmldata_root(wim, out), image_index_to_update+1)
+		since = ux2nttime(ctime - 2) if ctime is not None else 0 # a full read, if unknown
+		hashes = get_unchanged(entries, srcdir, direntries, directories, RefCounts, since)
+		print "%d file resources unchanged, reading only the changed and new ones..." % len(hashes)
 
 	# Flags the header for writing in progress
 	wim.dwFlags |= 0x40
@@ -87,7 +127,7 @@ def update(opts, args):
 	out.seek(0, 2)
 	
 	print "Packing contents..."
-	totalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime)
+	totalBytes, RefCounts = make_fileresources(out, COMPRESSION_TYPE, entries, RefCounts, total_input_bytes, StartTime, codec, get_hash_cache(opts), hashes)
 
 	sd_raw = security.tostr()
 
@@ -107,9 +147,9 @@ def update(opts, args):
 
 	meta_size = meta.tell() # uncomp/comp size
 	meta.seek(0)
-	Codecs.Codec.compress(meta, out, meta_size, True)
+	codec.compress(meta, out, meta_size, True)
 
-	crc = Codecs.Codec.sha1.digest()
+	crc = codec.sha1.digest()
 
 	if crc in offset_table:
 		print "No files to add, image is equal to another one!"
@@ -124,7 +164,7 @@ def update(opts, args):
 	wim.rhOffsetTable.liOffset = out.tell()
 	logging.debug("Writing Offset table @0x%08X", wim.rhOffsetTable.liOffset)
 	if not image_already_stored:
-		images[image_index_to_update] = make_offsetimage(Codecs.Codec, image_start)
+		images[image_index_to_update] = make_offsetimage(codec, image_start)
 	else:
 		for i in range(len(images)):
 			if images[i].bHash == crc:
@@ -150,6 +190,8 @@ def update(opts, args):
 	
 	finalize_wimheader(wim, out)
 
+	print_probe(codec)
+	print_memo(codec)
 	print_timings(StartTime, StopTime)
 
 
@@ -170,10 +212,9 @@ def delete(opts, args):
 		
 	COMPRESSION_TYPE = get_wim_comp(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = Codecs.get_codec(opts, COMPRESSION_TYPE, get_wim_chunk_size(wim))
 
-	offset_table = get_offsettable(out, wim)
-	images = get_images(out, wim)
+	offset_table, images = load_offsettable(out, wim)
 	
 	image_index_to_update = get_image_from_id(wim, out, args[1])
 
@@ -184,13 +225,11 @@ def delete(opts, args):
 	print "Opening WIM for delete, image #%d..." % image_index_to_update
 	image_index_to_update -= 1
 	
-	for o in offset_table.values():
-		if o.rhOffsetEntry.bFlags & 2: # skips image resource
-			continue
-		RefCounts[o.bHash] = [o.rhOffsetEntry.liOffset, o.rhOffsetEntry.liOriginalSize, o.rhOffsetEntry.ullSize, o.dwRefCount, o.rhOffsetEntry.bFlags]
+	for r in offset_table.iterresources(): # skips image resources
+		RefCounts[r[0]] = list(r[1:]) # offset, size, compressed size, count, flags
 
 	print "Opening Metadata resource..."
-	metadata = get_metadata(out, images[image_index_to_update])
+	metadata = get_metadata(out, images[image_index_to_update], codec)
 
 	direntries, directories = get_direntries(metadata)
 
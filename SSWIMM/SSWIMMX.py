@@ -23,22 +23,22 @@ from SSWIMMC import *
 from SSWIMMD import *
 
 
-def copyres2(ote, fp_in, fp_out):
+def copyres2(ote, fp_in, fp_out, codec, new_codec, guid=None):
 	"Copies a file resource, changing its compression"
-	isGood, fp = get_resource(fp_in, ote, False)
+	isGood, fp = get_resource(fp_in, ote, codec, False, guid=guid)
 	if not isGood:
 		logging.debug("Corrupted resource @0x%08X, simply copied!", ote.rhOffsetEntry.liOffset)
 		print "Corrupted resource @0x%08X, simply copied!" % ote.rhOffsetEntry.liOffset
 		copyres(ote.rhOffsetEntry.liOffset, ote.rhOffsetEntry.ullSize, fp_in, fp_out)
 		fp.close()
 		return
-	Codecs.Codec2.compress(fp, fp_out, ote.rhOffsetEntry.liOriginalSize)
-	if Codecs.Codec2.osize < ote.rhOffsetEntry.liOriginalSize:
+	new_codec.compress(fp, fp_out, ote.rhOffsetEntry.liOriginalSize)
+	if new_codec.osize < ote.rhOffsetEntry.liOriginalSize:
 		ote.rhOffsetEntry.bFlags |= 4 # compressed
 	elif ote.rhOffsetEntry.bFlags & 4:
 		ote.rhOffsetEntry.bFlags ^= 4 # uncompressed
-	logging.debug("Recompressed resource @0x%08X from %d to %d bytes", ote.rhOffsetEntry.liOffset, ote.rhOffsetEntry.ullSize, Codecs.Codec2.osize)
-	ote.rhOffsetEntry.ullSize = Codecs.Codec2.osize
+	logging.debug("Recompressed resource @0x%08X from %d to %d bytes", ote.rhOffsetEntry.liOffset, ote.rhOffsetEntry.ullSize, new_codec.osize)
+	ote.rhOffsetEntry.ullSize = new_codec.osize
 	fp.close()
 
 
@@ -52,17 +52,16 @@ def export(opts, args):
 	wim = get_wimheader(fpi)
 
 	NEW_COMPRESSION_TYPE = COMPRESSION_TYPE = get_wim_comp(wim)
+	NEW_CHUNK_SIZE = CHUNK_SIZE = get_wim_chunk_size(wim)
 
-	Codecs.Codec = CodecMT(opts.num_threads, COMPRESSION_TYPE)
+	codec = new_codec = Codecs.get_codec(opts, COMPRESSION_TYPE, CHUNK_SIZE)
 
-	offset_table = get_offsettable(fpi, wim)
+	offset_table, images = load_offsettable(fpi, wim)
 	
 	if args[1] == '*': # special case: exports ALL
 		img_index = 0
 	else:
 		img_index = get_image_from_id(wim, fpi, args[1])
-
-	images = get_images(fpi, wim)
 	
 	if img_index > len(images):
 		print "Image doesn't exist!"
@@ -78,19 +77,19 @@ def export(opts, args):
 		fpo = open(args[2], 'r+b')
 		new_wim = get_wimheader(fpo)
 		NEW_COMPRESSION_TYPE = get_wim_comp(new_wim)
-		if COMPRESSION_TYPE != NEW_COMPRESSION_TYPE:
-			Codecs.Codec2 = CodecMT(opts.num_threads, NEW_COMPRESSION_TYPE)
-		new_images = get_images(fpo, new_wim)
-		new_offset_table = get_offsettable(fpo, new_wim)
+		NEW_CHUNK_SIZE = get_wim_chunk_size(new_wim)
+		if (COMPRESSION_TYPE, CHUNK_SIZE) != (NEW_COMPRESSION_TYPE, NEW_CHUNK_SIZE):
+			new_codec = Codecs.get_codec(opts, NEW_COMPRESSION_TYPE, NEW_CHUNK_SIZE)
+		new_offset_table, new_images = load_offsettable(fpo, new_wim)
 		xml_data = get_xmldata(fpo, new_wim)
 		fpo.seek(0, 2) # SEEK_END
 	else:	# Create the new WIM unit
 		fpo = open(args[2], 'wb')
-		new_wim = make_wimheader(COMPRESSION_TYPE)
+		new_wim = make_wimheader(COMPRESSION_TYPE, CHUNK_SIZE)
 		new_wim.dwImageCount = 0
 		fpo.write(new_wim.tostr())
 		new_images = []
-		new_offset_table = OrderedDict()
+		new_offset_table = OffsetTable()
 		xml_data = ''
 	
 	for image in images:
@@ -104,7 +103,7 @@ def export(opts, args):
 		logging.debug("Exporting Image #%d to Image #%d", wim.dwImageCount, new_wim.dwImageCount)
 		
 		print "Opening Metadata resource..."
-		metadata = get_metadata(fpi, image)
+		metadata = get_metadata(fpi, image, codec, wim.gWIMGuid)
 
 		print "Opening DIRENTRY table..."
 		direntries, directories = get_direntries(metadata)
@@ -124,26 +123,22 @@ def export(opts, args):
 		print "Exporting the resources..."
 
 		# Sorts by on-disk resource offset
-		NULLK = 20*'\0'
-		def direntries_sort(a, b):
-			if a[0] == NULLK or b[0] == NULLK: return 0
-			return cmp(offset_table[a[0]].rhOffsetEntry.liOffset, offset_table[b[0]].rhOffsetEntry.liOffset)
-		direntries = OrderedDict(sorted(direntries.items(), direntries_sort))
+		direntries = OrderedDict(sorted(direntries.items(), key=lambda x: offset_table.rank(x[0])))
 
 		total_done_bytes = 0
 		for bHash in direntries:
 			if bHash not in offset_table: continue
 			if bHash in new_offset_table:
-				new_offset_table[bHash].dwRefCount += len(direntries[bHash])
+				new_offset_table.add_refs(bHash, len(direntries[bHash]))
 				continue
 			ote = offset_table[bHash]
 			if not ote.dwRefCount: # skips unused resources
 				continue
 			liOffset = fpo.tell()
-			if COMPRESSION_TYPE == NEW_COMPRESSION_TYPE:
+			if codec is new_codec: # same compression and chunk size
 				copyres(ote.rhOffsetEntry.liOffset, ote.rhOffsetEntry.ullSize, fpi, fpo)
 			else:
-				copyres2(ote, fpi, fpo)
+				copyres2(ote, fpi, fpo, codec, new_codec) # read once, not cached
 			ote.rhOffsetEntry.liOffset = liOffset # update resource offset
 			ote.dwRefCount = len(direntries[bHash])
 			new_offset_table[bHash] = ote
@@ -154,10 +149,10 @@ def export(opts, args):
 		print "Exporting the Metadata..."
 		image_start = fpo.tell()
 		logging.debug("Image start @%08X", image_start)
-		if COMPRESSION_TYPE == NEW_COMPRESSION_TYPE:
+		if codec is new_codec: # same compression and chunk size
 			copyres(image.rhOffsetEntry.liOffset, image.rhOffsetEntry.ullSize, fpi, fpo)
 		else:
-			copyres2(image, fpi, fpo)
+			copyres2(image, fpi, fpo, codec, new_codec, wim.gWIMGuid)
 
 		StopTime = time.time()
 
@@ -173,8 +168,7 @@ def export(opts, args):
 
 		logging.debug("Metadata resource @%0X for %d bytes (%d original)",image.rhOffsetEntry.liOffset, image.rhOffsetEntry.ullSize, image.rhOffsetEntry.liOriginalSize)
 		
-		for bHash in new_offset_table:
-			ote = new_offset_table[bHash]
+		for ote in new_offset_table.itervalues():
 			if ote.rhOffsetEntry.bFlags & 2: # skips image resources
 				continue
 			fpo.write(ote.tostr())
@@ -9,16 +9,20 @@ COPYRIGHT = '''Copyright (C)2012-2013, by maxpat78. GNU GPL v2 applies.
 This free software manages MS WIM Archives WITH ABSOLUTELY NO WARRANTY!'''
 
 import Codecs
+import array
+import bisect
 import copy
 import datetime
 import hashlib
 import logging
 import os
+import stat
 import struct
 import sys
 import tempfile
 import time
 import uuid
+import w32_fnmatch
 from collections import OrderedDict
 from ctypes import *
 from cStringIO import StringIO
@@ -59,6 +63,18 @@ def ux2nttime(t):
 	"Converts date/time from Unix into NT"
 	return int((t+11644473600L)*10000000L)
 
+def make_exclusion_matcher(excludes):
+	"""Compiles once the Win32 wildcards of the items to exclude, returning a function that tells
+	if a pathname is one of them or, if they are folders, is inside one of them"""
+	if not excludes:
+		return lambda s: False
+	# if the excluded item is a dir, we want subcontents excluded also! (x+\*)
+	rx = w32_fnmatch.win32_compile(list(excludes) + [x+'\\*' for x in excludes])
+	def is_excluded(s):
+		i_pname = s[s.find('\\'):] # pathname how it will be inside the image
+		return rx.match(os.path.normcase(i_pname)) is not None
+	return is_excluded
+
 def take_sha(pathname, _blklen=32*1024, first_chunk=False):
 	"Calculates the SHA-1 for file contents"
 	pos = -1
@@ -131,7 +147,7 @@ if os.name == 'nt':
 			logging.debug("Can't apply datetimes to '%s'!", pathname)
 		windll.kernel32.CloseHandle(hFile)
 
-	def get_ads_vista(pathname):
+	def get_ads_vista(pathname, st=None):
 		"Returns the Alternate Data Streams for a file"
 		ads = []
 
@@ -143,7 +159,7 @@ if os.name == 'nt':
 		if h != -1:
 			while windll.kernel32.FindNextStreamW(h, byref(fsd)): # CAVE! Fails with junction points!
 				if not fsd.cStreamName.endswith('$DATA'): continue
-				se = StreamEntry(64*'\0')
+				se = StreamEntry()
 				se.FileSize = fsd.StreamSize
 				se.StreamName = fsd.cStreamName[1:-6].encode('utf-16le')
 				se.wStreamNameLength = len(se.StreamName)
@@ -153,7 +169,7 @@ if os.name == 'nt':
 			windll.kernel32.CloseHandle(h)
 		return ads
 
-	def get_ads_xp(pathname):
+	def get_ads_xp(pathname, st=None):
 		"Returns the Alternate Data Streams for a file (XP)"
 		# FILE_FLAG_BACKUP_SEMANTICS
 		hFile = windll.kernel32.CreateFileW(pathname, 0x80000000, 1, 0, 3, 0x02000000, 0)
@@ -182,7 +198,7 @@ if os.name == 'nt':
 				windll.kernel32.BackupRead(hFile, addressof(buf)+sizeof(WIN32_STREAM_ID), wsid.dwStreamNameSize, byref(cb_read), 0, 1, byref(context))
 				#~ print buf[j: j+wsid.dwStreamNameSize]
 				s = cast(buf[j: j+wsid.dwStreamNameSize]+'\0\0', c_wchar_p).value
-				se = StreamEntry(64*'\0')
+				se = StreamEntry()
 				se.FileSize = wsid.Size
 				se.StreamName = s[1:-6]#.encode('utf-16le')
 				se.wStreamNameLength = len(se.StreamName)
@@ -223,7 +239,7 @@ if os.name == 'nt':
 			return False
 		return True
 
-	def IsReparsePoint(pathname):
+	def IsReparsePoint(pathname, st=None):
 		"Test if the object is a symbolic link or a junction point"
 		if not pathname: return False
 		ret = windll.kernel32.GetFileAttributesW(pathname)
@@ -232,7 +248,7 @@ if os.name == 'nt':
 		else:
 			return False
 
-	def IsHardlinkedFile(pathname):
+	def IsHardlinkedFile(pathname, st=None):
 		"Test if a file has hard links"
 		if not pathname: return False
 		hFile = windll.kernel32.CreateFileW(pathname, 0x80000100, 0, 0, 3, 0x02200000, 0)
@@ -246,7 +262,7 @@ if os.name == 'nt':
 		windll.kernel32.CloseHandle(hFile)
 		return ret
 
-	def GetReparsePointTag(pathname):
+	def GetReparsePointTag(pathname, st=None):
 		"Retrieves the IO_REPARSE_TAG associated with a reparse point"
 		wfd = WIN32_FIND_DATA()
 		h = windll.kernel32.FindFirstFileW(pathname, byref(wfd))
@@ -306,35 +322,39 @@ else: # posix
 			logging.debug("Can't touch %s", pathname)
 		return
 
-	def get_ads(pathname):
+	# The helpers below take the os.lstat result of the object, if the caller has it already
+
+	def get_ads(pathname, st=None):
 		"Returns the Alternate Data Streams for a file"
 		# This is compatible with wimlib-imagex ONLY!
-		st = os.lstat(pathname)
+		st = st or os.lstat(pathname)
 		s = struct.pack("<HHHH", 0, st.st_uid, st.st_gid, st.st_mode)
-		se = StreamEntry(64*'\0')
+		se = StreamEntry()
 		se.FileSize = len(s)
 		se.StreamName = '$$__wimlib_UNIX_data'.encode('utf-16le')
 		se.wStreamNameLength = len(se.StreamName)
 		se.SrcPathname = StringIO(s)
 		return [se]
 
-	def IsReparsePoint(pathname):
+	def IsReparsePoint(pathname, st=None):
 		"Test if the object is a symbolic link or a junction point"
 		if not pathname: return False
+		if st: return stat.S_ISLNK(st.st_mode)
 		if os.path.islink(pathname): return True
 		return False
 
-	def IsHardlinkedFile(pathname):
+	def IsHardlinkedFile(pathname, st=None):
 		"Test if a file has hard links"
 		if not pathname: return False
-		if not os.path.islink(pathname) and os.stat(pathname).st_nlink > 1:
-			return (0, os.stat(pathname).st_ino) # is inode a 32-bit number?
+		st = st or os.lstat(pathname)
+		if not stat.S_ISLNK(st.st_mode) and st.st_nlink > 1:
+			return (0, st.st_ino) # is inode a 32-bit number?
 		else:
 			return None
 
-	def GetReparsePointTag(pathname):
+	def GetReparsePointTag(pathname, st=None):
 		"Retrieves the IO_REPARSE_TAG associated with a reparse point"
-		if os.path.islink(pathname): return 0xA000000C
+		if IsReparsePoint(pathname, st): return 0xA000000C
 
 	def GetReparsePointData(pathname, srcdir):
 		"Retrieves and fixes the REPARSE_DATA_BUFFER associated with a reparse point"
@@ -423,6 +443,22 @@ else:
 def print_timings(start, stop):
 	print "Done. %s time elapsed." % datetime.timedelta(seconds=int(stop-start))
 
+def print_probe(codec):
+	"Reports the streams stored uncompressed by the compressibility probe"
+	if codec.probe:
+		print "%d of %d probed streams stored without compression." % (codec.compressions_skipped, codec.probed)
+
+def print_memo(codec):
+	"Reports the chunks whose compression was reused from the chunk memo"
+	if codec.memo and codec.memo.hits:
+		print "%d of %d chunks reused already compressed (%d zeroed)." % (codec.memo.hits, codec.memo.hits+codec.memo.misses, codec.memo.zero_hits)
+
+def print_cache(codec):
+	"Reports the chunks served by the decompressed chunk cache"
+	cache = codec.cache
+	if cache and cache.hits:
+		print "%d chunks (%d bytes) served by the chunk cache, %.1f%% hit ratio." % (cache.hits, cache.bytes_saved, cache.hit_ratio()*100)
+
 def wim_is_clean(wim, fp):
 	"Ensures there's no garbage after XML data"
 	if wim.dwFlags & 0x40 and wim.rhXmlData.liOffset + wim.rhXmlData.ullSize < os.stat(fp.name):
@@ -439,6 +475,10 @@ def get_wim_comp(wim):
 	print "Compression is", ('none', 'XPRESS', 'LZX')[COMPRESSION_TYPE]
 	return COMPRESSION_TYPE
 
+def get_wim_chunk_size(wim):
+	"Returns the uncompressed size of the chunks in the WIM resources"
+	return wim.dwCompressionSize or 32768
+
 
 class BadWim(Exception):
 	pass
@@ -560,8 +600,12 @@ class SecurityData:
 
 	def addobject(self, pathname):
 		"Adds a single instance of an object's SD into a table, returning its index"
+		return self.addsd(self.getsd(pathname))
+
+	def getsd(self, pathname):
+		"Reads an object's SD, or returns None. It may run in any thread."
 		if sys.platform not in ('win32', 'cygwin'):
-			return -1
+			return None
 		lpLenNeeded = c_int()
 		# OWNER_SECURITY_INFORMATION=1 GROUP_SECURITY_INFORMATION=2 DACL_SECURITY_INFORMATION=4
 		SecurityInfo = 7
@@ -570,19 +614,24 @@ class SecurityData:
 		windll.advapi32.GetFileSecurityW(pathname, SecurityInfo, None, None, byref(lpLenNeeded))
 		s = create_string_buffer(lpLenNeeded.value)
 		ret = windll.advapi32.GetFileSecurityW(pathname, SecurityInfo, s, lpLenNeeded.value, byref(lpLenNeeded))
-		ind = -1
 		if ret and windll.advapi32.IsValidSecurityDescriptor(s):
-			sha1 = hashlib.sha1(s).digest()
-			if sha1 in self.SDS:
-				ind = self.SDS.keys().index(sha1)
-				logging.debug("SD already indexed as #%d", ind)
-			else:
-				self.SDS[sha1] = s
-				ind = len(self.SDS) - 1
-				logging.debug("Added new SD with index #%d", ind)
-				self.dwTotalLength += 8 + len(s)
+			return s
+		logging.debug("GetFileSecurityW failed on '%s'", pathname)
+		return None
+
+	def addsd(self, s):
+		"Adds a single instance of a SD read with getsd into the table, returning its index"
+		if s is None:
+			return -1
+		sha1 = hashlib.sha1(s).digest()
+		if sha1 in self.SDS:
+			ind = self.SDS.keys().index(sha1)
+			logging.debug("SD already indexed as #%d", ind)
 		else:
-			logging.debug("GetFileSecurityW failed on '%s'", pathname)
+			self.SDS[sha1] = s
+			ind = len(self.SDS) - 1
+			logging.debug("Added new SD with index #%d", ind)
+			self.dwTotalLength += 8 + len(s)
 		return ind
 
 	def apply(self, index, pathname):
@@ -602,7 +651,42 @@ class SecurityData:
 		return self.dwTotalLength + pad # QWORD aligned size
 
 
-class DirEntry:
+def layout_struct(layout, skip=()):
+	"Compiles a record layout into a Struct, returning it with the field names in offset order"
+	fmt, names, pos = '<', [], 0
+	for k in sorted(layout):
+		if k in skip: continue
+		name, f = layout[k]
+		assert k == pos, "%s: layout hole at 0x%X" % (name, k)
+		fmt += f.lstrip('<')
+		names += [name]
+		pos = struct.calcsize(fmt)
+	st = struct.Struct(fmt)
+	return st, tuple(names), st.unpack(st.size*'\0')
+
+def layout_assigner(names):
+	"Compiles a function storing a tuple of values into the named attributes with one statement, like namedtuple does"
+	ns = {}
+	exec 'def assign(self, values):\n\t%s, = values\n' % ', '.join(['self.'+x for x in names]) in ns
+	return ns['assign']
+
+class Record(object):
+	"""Base of the records repeated many times (DIRENTRYs, STREAMENTRYs, offset table entries):
+	their fields are decoded at once by a Struct shared by the class and kept in slots"""
+	__slots__ = ('_pos', 'size')
+
+	def __init__(self, s=None, offset=0):
+		self._pos = 0 # posizione nel buffer
+		if s:
+			self._assign(self._struct.unpack_from(s, offset))
+		else:
+			self._assign(self._zero)
+
+	def tostr (self):
+		return self._struct.pack(*[getattr(self, name) for name in self._names])
+
+
+class DirEntry(Record):
 	"Represents a file or folder captured inside an image"
 	layout = { # 0x66 bytes
 	0x00: ('liLength', '<Q'), # Length of this DIRENTRY
@@ -624,40 +708,35 @@ class DirEntry:
 	}
 	# Unicode UTF-16-LE entry name follows, terminated by a Unicode NULL (not mentioned in spec, nor counted in wFileNameLength),
 	# QWORD aligned (spec says DWORD)
-	def __init__(self, s):
-		self._i = 0 # posizione nel buffer
-		self._pos = 0 # posizione nel buffer
-		self._buf = s
-		self._kv = DirEntry.layout.copy()
-		self._vk = {} # { name: offset}
-		for k, v in self._kv.items():
-			self._vk[v[0]] = k
+	_kv = layout
+	_struct, _names, _zero = layout_struct(layout)
+	_assign = layout_assigner(_names)
+	# fields, names, and the attributes set while capturing (source, stat, SD, resource) or parsing (position)
+	__slots__ = _names + ('FileName', 'ShortFileName', 'RefCount', '_parent', 'alt_data_streams',
+	'SrcPathname', 'stamp', 'sd', 'sReparseData', 'FileSize', 'Offset', 'cFileSize', 'bCompressed')
+
+	def __init__(self, s=None, offset=0):
+		Record.__init__(self, s, offset)
 		self.size = 0
 		if self.wFileNameLength:
-			self.FileName = (self._buf[0x66:0x66+self.wFileNameLength]).decode('utf-16le')
+			i = offset + 0x66
+			self.FileName = s[i:i+self.wFileNameLength].decode('utf-16le')
 		else:
 			self.FileName = ''
 		self.RefCount = 1 # reference count
-		
-	__getattr__ = common_getattr
 	
 	def __str__ (self):
 		return class2str(self, "DirEntry @%x\n" % self._pos) + '66: sFileName = %s' % self.FileName.encode('utf8')
 
 	def tostr (self):
-		s = ''
-		keys = self._kv.keys()
-		keys.sort()
-		for k in keys:
-			v = self._kv[k]
-			s += struct.pack(v[1], getattr(self, v[0]))
+		s = Record.tostr(self)
 		s += self.FileName
 		if hasattr(self, 'ShortFileName'):
 			s += '\0\0' + self.ShortFileName
 		return s + (self.liLength-len(s))*'\0'
 
 
-class StreamEntry:
+class StreamEntry(Record):
 	"Represents an alternate stream entry"
 	layout = { # 0x26 (38) bytes
 	0x00: ('liLength', '<Q'), # Length of this STREAMENTRY
@@ -667,35 +746,28 @@ class StreamEntry:
 	}
 	# Unicode UTF-16-LE entry name follows, terminated by a Unicode NULL (not mentioned in spec, nor counted in wStreamNameLength),
 	# QWORD aligned itself
+	_kv = layout
+	_struct, _names, _zero = layout_struct(layout)
+	_assign = layout_assigner(_names)
+	__slots__ = _names + ('StreamName', 'FileName', 'parent', '_parent',
+	'SrcPathname', 'FileSize', 'Offset', 'cFileSize', 'bCompressed')
 	
-	def __init__(self, s):
-		self._i = 0
-		self._pos = 0
-		self._buf = s
-		self._kv = StreamEntry.layout.copy()
-		self._vk = {} # { name: offset}
-		for k, v in self._kv.items():
-			self._vk[v[0]] = k
+	def __init__(self, s=None, offset=0):
+		Record.__init__(self, s, offset)
 		self.size = 0
 		if self.wStreamNameLength:
-			self.StreamName = (self._buf[0x26:0x26+self.wStreamNameLength]).decode('utf-16le')
+			i = offset + 0x26
+			self.StreamName = s[i:i+self.wStreamNameLength].decode('utf-16le')
 		else:
 			self.StreamName = ''
 		self.FileName = self.StreamName
-		
-	__getattr__ = common_getattr
 	
 	def __str__ (self):
 		return class2str(self, "StreamEntry @%x\n" % self._pos) + '26: sStreamName = %s' % self.StreamName
 
 	def tostr (self):
 		self.length()
-		s = ''
-		keys = self._kv.keys()
-		keys.sort()
-		for k in keys:
-			v = self._kv[k]
-			s += struct.pack(v[1], getattr(self, v[0]))
+		s = Record.tostr(self)
 		s += self.StreamName + '\0\0'
 		return s + (self.liLength-len(s))*'\0'
 
@@ -707,7 +779,7 @@ class StreamEntry:
 		logging.debug("StreamEntry padded size=%x", self.liLength)
 		return self.liLength
 
-class DiskResHdr:
+class DiskResHdr(Record):
 	"Represents size, position and type of a resource inside the WIM file"
 	layout = { # 0x18 (24) bytes
 	0x00: ('ullSize', '<Q'), # compressed size (56 bits) + 8-bit Flags
@@ -715,37 +787,25 @@ class DiskResHdr:
 	0x08: ('liOffset', '<Q'), # offset
 	0x10: ('liOriginalSize', '<Q') # original uncompressed size
 	}
+	_kv = layout
+	_struct, _names, _zero = layout_struct(layout, skip=(7,)) # bFlags is ullSize top byte
+	_assign = layout_assigner(_names)
+	__slots__ = _names + ('bFlags',)
 	
 	def __init__(self, s=None):
+		Record.__init__(self, s)
 		self.size = 24
-		self._i = 0 # posizione nel buffer
-		self._pos = 0 # posizione nel buffer
-		self._buf = s
-		self._kv = DiskResHdr.layout.copy()
-		self._vk = {} # { nome: offset}
-		for k, v in self._kv.items():
-			self._vk[v[0]] = k
+		self.bFlags = self.ullSize >> 56
 		self.ullSize = self.ullSize & 0x00FFFFFFFFFFFFFF
-
-	__getattr__ = common_getattr
 	
 	def __str__ (self):
 		return class2str(self, "DiskRes Header @%x\n" % self._pos)
 
 	def tostr (self):
-		s = ''
-		keys = self._kv.keys()
-		keys.sort()
-		self.ullSize = self.ullSize | (self.bFlags << 56)
-		for k in keys:
-			if k == 7: continue
-			v = self._kv[k]
-			s += struct.pack(v[1], getattr(self, v[0]))
-		self.ullSize = self.ullSize & 0x00FFFFFFFFFFFFFF
-		return s
+		return self._struct.pack(self.ullSize | (self.bFlags << 56), self.liOffset, self.liOriginalSize)
 
 
-class OffsetTableEntry:
+class OffsetTableEntry(Record):
 	"Represents position, type, sizes, reference count and SHA-1 hashes of captured resources"
 	layout = { # 0x32 (50) bytes
 	0x00: ('rhOffsetEntry', '24s'),
@@ -753,19 +813,22 @@ class OffsetTableEntry:
 	0x1A: ('dwRefCount', '<I'), # SPECS SAY A WORD!
 	0x1E: ('bHash', '20s') # SHA-1 hash (uncompressed data)
 	}
+	_kv = layout
+	_struct, _names, _zero = layout_struct(layout)
+	__slots__ = _names
+	_flat = struct.Struct('<QQQHI20s') # the same, with the resource header fields
+	size = 50
 	
-	def __init__(self, s=None):
-		self.size = 50
-		self._i = 0 # posizione nel buffer
-		self._pos = 0 # posizione nel buffer
-		self._buf = s
-		self._kv = OffsetTableEntry.layout.copy()
-		self._vk = {} # { nome: offset}
-		for k, v in self._kv.items():
-			self._vk[v[0]] = k
-		self.rhOffsetEntry = DiskResHdr(self.rhOffsetEntry)
-
-	__getattr__ = common_getattr
+	def __init__(self, s=None, offset=0):
+		"Decodes the entry at offset in s (an offset table read at once, i.e.)"
+		self._pos = 0
+		h = self.rhOffsetEntry = DiskResHdr()
+		if s:
+			h.ullSize, h.liOffset, h.liOriginalSize, self.usPartNumber, self.dwRefCount, self.bHash = self._flat.unpack_from(s, offset)
+			h.bFlags = h.ullSize >> 56
+			h.ullSize &= 0x00FFFFFFFFFFFFFF
+		else:
+			self.usPartNumber, self.dwRefCount, self.bHash = self._zero[1:]
 	
 	def __str__ (self):
 		return class2str(self, "OffsetTable @%x\n" % self._pos)
@@ -774,14 +837,129 @@ class OffsetTableEntry:
 		return class2str(self, "OffsetTable @%x\n" % self._pos)
 
 	def tostr (self):
-		s = ''
-		keys = self._kv.keys()
-		keys.sort()
-		s += struct.pack(self._kv[0][1], getattr(self, self._kv[0][0]).tostr())
-		for k in keys[1:]:
-			v = self._kv[k]
-			s += struct.pack(v[1], getattr(self, v[0]))
-		return s
+		return self._struct.pack(self.rhOffsetEntry.tostr(), self.usPartNumber, self.dwRefCount, self.bHash)
+
+
+class OffsetTable(object):
+	"""The offset table kept by columns, a row per resource in table order: the hashes are
+	indexed in sorted order to find a row by bisection, and the rows' order by offset on disk
+	is computed once. Entries go in and come out as OffsetTableEntry objects, but reading a
+	field or changing a reference count touches just a column"""
+	# 'L' is 32-bit on Windows: there, doubles keep offsets and sizes exactly up to 2^53
+	_u64 = 'L' if array.array('L').itemsize == 8 else 'd'
+	_columns = ('ullSize', 'bFlags', 'liOffset', 'liOriginalSize', 'usPartNumber', 'dwRefCount')
+
+	def __init__(self, s=''):
+		"Decodes an offset table read at once"
+		n = OffsetTableEntry.size
+		rows = [OffsetTableEntry._flat.unpack_from(s, i) for i in xrange(0, len(s) - n + 1, n)]
+		cols = zip(*rows) or 6*[()]
+		self.hashes = list(cols[5])
+		self.ullSize = array.array(self._u64, [x & 0x00FFFFFFFFFFFFFF for x in cols[0]])
+		self.bFlags = array.array('B', [x >> 56 for x in cols[0]])
+		self.liOffset = array.array(self._u64, cols[1])
+		self.liOriginalSize = array.array(self._u64, cols[2])
+		self.usPartNumber = array.array('H', cols[3])
+		self.dwRefCount = array.array('I', cols[4])
+		last = dict(zip(self.hashes, xrange(len(rows))))
+		if len(last) < len(rows): # a repeated hash keeps its first place and its last values, like a dictionary
+			rows = [i for i in (last.pop(h, None) for h in self.hashes) if i is not None]
+			self.hashes = [self.hashes[i] for i in rows]
+			for name in self._columns:
+				col = getattr(self, name)
+				setattr(self, name, array.array(col.typecode, [col[i] for i in rows]))
+		order = sorted(xrange(len(rows)), key=self.hashes.__getitem__)
+		self._keys = [self.hashes[i] for i in order]
+		self._rows = array.array('I', order)
+		self._order = None
+
+	def __len__(self):
+		return len(self.hashes)
+
+	def __iter__(self):
+		return iter(self.hashes)
+
+	def __contains__(self, bHash):
+		return self.find(bHash) > -1
+
+	def __getitem__(self, bHash):
+		return self.entry(self.row(bHash))
+
+	def __setitem__(self, bHash, ote):
+		"Adds or replaces the row of a hash with an OffsetTableEntry contents"
+		i = self.find(bHash)
+		if i < 0:
+			i = len(self.hashes)
+			j = bisect.bisect_left(self._keys, bHash)
+			self._keys.insert(j, bHash)
+			self._rows.insert(j, i)
+			self.hashes += [bHash]
+			for name in self._columns:
+				getattr(self, name).append(0)
+		h = ote.rhOffsetEntry
+		self.ullSize[i], self.bFlags[i], self.liOffset[i], self.liOriginalSize[i] = h.ullSize, h.bFlags, h.liOffset, h.liOriginalSize
+		self.usPartNumber[i], self.dwRefCount[i] = ote.usPartNumber, ote.dwRefCount
+		self._order = None
+
+	def find(self, bHash):
+		"Returns the row of a hash, or -1"
+		j = bisect.bisect_left(self._keys, bHash)
+		if j < len(self._keys) and self._keys[j] == bHash:
+			return self._rows[j]
+		return -1
+
+	def row(self, bHash):
+		"Returns the row of a hash, or raises KeyError"
+		i = self.find(bHash)
+		if i < 0: raise KeyError(bHash)
+		return i
+
+	def field(self, bHash, name):
+		"Returns a field (a column name) of the entry of a hash"
+		return int(getattr(self, name)[self.row(bHash)])
+
+	def entry(self, i):
+		"Makes an OffsetTableEntry from a row"
+		ote = OffsetTableEntry()
+		h = ote.rhOffsetEntry
+		h.ullSize, h.bFlags, h.liOffset, h.liOriginalSize = int(self.ullSize[i]), self.bFlags[i], int(self.liOffset[i]), int(self.liOriginalSize[i])
+		ote.usPartNumber, ote.dwRefCount, ote.bHash = self.usPartNumber[i], self.dwRefCount[i], self.hashes[i]
+		return ote
+
+	def values(self):
+		return [self.entry(i) for i in xrange(len(self.hashes))]
+
+	def itervalues(self):
+		for i in xrange(len(self.hashes)):
+			yield self.entry(i)
+
+	def iterresources(self):
+		"Yields hash, offset, original size, size, reference count and flags of the file resources (not the images)"
+		for i in xrange(len(self.hashes)):
+			if self.bFlags[i] & 2: continue
+			yield self.hashes[i], int(self.liOffset[i]), int(self.liOriginalSize[i]), int(self.ullSize[i]), self.dwRefCount[i], self.bFlags[i]
+
+	def add_refs(self, bHash, count):
+		self.dwRefCount[self.row(bHash)] += count
+
+	def _sort_offsets(self):
+		self._order = array.array('I', sorted(xrange(len(self.hashes)), key=self.liOffset.__getitem__))
+		self._rank = array.array('I', self._order) # rank of each row in offset order
+		for j, i in enumerate(self._order):
+			self._rank[i] = j
+
+	def by_offset(self):
+		"Yields the hashes in the order of their resources on disk"
+		if self._order is None: self._sort_offsets()
+		for i in self._order:
+			yield self.hashes[i]
+
+	def rank(self, bHash):
+		"Returns the position of a resource in the offset order, or -1 if the hash is unknown (i.e. the NULL one)"
+		i = self.find(bHash)
+		if i < 0: return -1
+		if self._order is None: self._sort_offsets()
+		return self._rank[i]
 
 
 class IntegrityTable:
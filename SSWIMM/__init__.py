@@ -13,3 +13,4 @@ from SSWIMMD import *
 from SSWIMMS import *
 from SSWIMMI import *
 from SSWIMMX import *
+from SSWIMMB import *
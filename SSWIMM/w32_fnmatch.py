@@ -1,4 +1,5 @@
 import fnmatch
+import os
 import re
 
 COPYRIGHT = '''Copyright (C)2012, by maxpat78. GNU GPL v2 applies.'''
@@ -92,6 +93,18 @@ def win32_translate(wild):
 	return res
 
 
+def win32_compile(wilds):
+	"""Compiles a list of Win32 wildcards into one regular expression, matching a name
+	(normalized with os.path.normcase, like fnmatch does) if any of them matches"""
+	res = []
+	for wild in wilds:
+		r = win32_translate(os.path.normcase(wild))
+		res += ['(?:%s)' % r[:-len('(?i)')]] # the flag is global
+	if not res:
+		return re.compile('(?!)') # matches nothing
+	return re.compile('|'.join(res), re.I)
+
+
 __all__ = ["filter", "fnmatch", "translate"]
 
 translate = win32_translate
@@ -191,6 +204,16 @@ if __name__ == '__main__':
 		if r != case[2]:
 			failed += 1
 			print "'%s' ~= '%s' is %s, expected %s" % (case[0], case[1], r, case[2])
+		if (win32_compile([case[1]]).match(case[0]) is not None) != r:
+			failed += 1
+			print "win32_compile differs from fnmatch on '%s' ~= '%s'" % (case[0], case[1])
+
+	rx = win32_compile([case[1] for case in cases])
+	for case in cases:
+		r = True in [fnmatch.fnmatch(case[0], c[1]) for c in cases]
+		if (rx.match(case[0]) is not None) != r:
+			failed += 1
+			print "win32_compile of all the wildcards differs from fnmatch on '%s'" % case[0]
 
 	if failed:
 		print "%d/%d tests failed!" % (failed, len(cases))